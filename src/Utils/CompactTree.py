@@ -0,0 +1,362 @@
+import numpy as np
+import networkx as nx
+from src.Utils.Newick import parse_nhx
+from itertools import chain, product, combinations
+from src.neighbor_joining.NanNeighborJoining import NJTree
+
+# Event codes stored per node
+EVENT_NONE = 0           # Internal node without a known event
+EVENT_SPECIATION = 1     # 'S'
+EVENT_DUPLICATION = 2    # 'D'
+EVENT_LOSS = 3           # Leaf labelled 'X'
+EVENT_GENE = 4           # Any other leaf
+
+LOSS_LABEL = 'X'
+_EVENT_OF_LABEL = {'S': EVENT_SPECIATION, 'D': EVENT_DUPLICATION}
+_NHX_ATTRIBUTES = ('label', 'node_id', 'species')  # Attributes stored as interned IDs; any other one goes to extras
+
+
+class LabelTable:
+    """
+    Interning table of the attribute values of a compact tree (and of the trees spliced from it): every distinct
+    value (str, int or None) is stored once and nodes refer to it by a small integer ID.
+    """
+    __slots__ = ('_ids', '_values')
+
+    def __init__(self):
+        self._ids: dict = {}
+        self._values: list = []
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def intern(self, value) -> int:
+        label_id = self._ids.get(value)
+        if label_id is None:
+            label_id = self._ids[value] = len(self._values)
+            self._values.append(value)
+        return label_id
+
+    def get_value(self, label_id: int):
+        return self._values[label_id]
+
+    def get_id(self, value) -> int:
+        """
+        Return the ID of a value, or -1 if it was never interned.
+        """
+        return self._ids.get(value, -1)
+
+
+def _event_code(is_leaf: bool, label, event) -> int:
+    if is_leaf:
+        return EVENT_LOSS if label == LOSS_LABEL else EVENT_GENE
+    return _EVENT_OF_LABEL.get(event if event is not None else label, EVENT_NONE)
+
+
+class CompactTree:
+    """
+    Array-backed rooted tree, a light replacement for the networkx.DiGraph trees of revolutionhtl.
+
+    Nodes are numbered 0..n-1 in preorder (children in their original order), so the subtree of v is the index range
+    [v, end(v)). A tree read from NHX keeps the node numbers read_nhxx gives, including its dummy root 0; the real
+    root of such a tree is node 1. Per node the tree stores:
+        parent[v]                               -1 for the root
+        children[offsets[v]:offsets[v + 1]]     children of v (CSR)
+        label_ids[v], node_ids[v], species[v]   IDs in the tree's LabelTable; -1 if the attribute is absent
+        events[v]                               EVENT_* code
+    Attributes other than label, node_id and species are kept in a sparse dictionary (extras).
+    """
+    __slots__ = (
+        '_parent', '_offsets', '_children', '_labels', '_label_ids', '_node_ids', '_species', '_events', '_extras',
+        '_ends'
+    )
+
+    def __init__(
+            self, parent: np.ndarray, offsets: np.ndarray, children: np.ndarray, label_ids: np.ndarray,
+            node_ids: np.ndarray, species: np.ndarray, extras: dict[int, dict] | None = None,
+            labels: LabelTable | None = None
+    ):
+        self._parent = parent
+        self._offsets = offsets
+        self._children = children
+        self._labels = labels if labels is not None else LabelTable()
+        self._label_ids = label_ids
+        self._node_ids = node_ids
+        self._species = species
+        self._extras = extras or {}
+        self._ends: np.ndarray | None = None  # end(v) of every subtree, computed on first use
+
+        is_leaf = np.diff(offsets) == 0
+        self._events = np.fromiter(
+            (_event_code(is_leaf[v], self.get_label(v), self._extras.get(v, {}).get('event'))
+             for v in range(len(parent))),
+            dtype=np.int8, count=len(parent)
+        )
+
+    @classmethod
+    def _from_children(
+            cls, root, children_of, attributes_of, labels: LabelTable | None = None, transform=None
+    ) -> "CompactTree":
+        """
+        Build a tree from any node representation.
+
+        :param root: Root node.
+        :param children_of: Function node -> list of child nodes, in order.
+        :param attributes_of: Function node -> dict of attributes.
+        :param labels: LabelTable used for the attribute values, or None for a new one: a table lives as long as
+            the trees that use it, so a long-running process does not keep every label it has seen.
+        :param transform: Optional function (attributes, is_leaf) -> attributes applied to every node on the way in.
+        """
+        if labels is None:
+            labels = LabelTable()
+
+        # Preorder numbering
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(reversed(children_of(node)))
+        index = {node: v for v, node in enumerate(order)}
+
+        n = len(order)
+        parent = np.full(n, -1, dtype=np.int32)
+        offsets = np.zeros(n + 1, dtype=np.int32)
+        children: list[int] = []
+        label_ids = np.full(n, -1, dtype=np.int32)
+        node_ids = np.full(n, -1, dtype=np.int32)
+        species = np.full(n, -1, dtype=np.int32)
+        extras: dict[int, dict] = {}
+
+        for v, node in enumerate(order):
+            kids = [index[child] for child in children_of(node)]
+            children.extend(kids)
+            offsets[v + 1] = len(children)
+            parent[kids] = v
+
+            attributes = attributes_of(node)
+            if transform is not None:
+                attributes = transform(attributes, not kids)
+            for attribute, column in (('label', label_ids), ('node_id', node_ids), ('species', species)):
+                if attribute in attributes:
+                    column[v] = labels.intern(attributes[attribute])
+            extra = {key: value for key, value in attributes.items() if key not in _NHX_ATTRIBUTES}
+            if extra:
+                extras[v] = extra
+
+        return cls(parent, offsets, np.array(children, dtype=np.int32), label_ids, node_ids, species, extras, labels)
+
+    @classmethod
+    def from_graph(cls, T: nx.DiGraph, root=None, labels: LabelTable | None = None, transform=None) -> "CompactTree":
+        """
+        Convert a revolutionhtl tree into a CompactTree. Only the nodes reachable from the root are kept.
+
+        :param root: Root node; defaults to the root attribute set by read_nhxx, else 0.
+        :param transform: See _from_children; T itself is not modified.
+        """
+        root = getattr(T, 'root', 0) if root is None else root
+        return cls._from_children(
+            root, lambda node: list(T.successors(node)), lambda node: T.nodes[node], labels, transform
+        )
+
+    @classmethod
+    def from_nhx(cls, nhx: str, labels: LabelTable | None = None, transform=None) -> "CompactTree":
+        """
+        Parse an NHX string (as read_nhxx does) into a CompactTree, without building a graph.
+
+        :param transform: See _from_children.
+        """
+        parents, attributes = parse_nhx(nhx)
+        children: list[list[int]] = [[] for _ in parents]
+        for v, parent in enumerate(parents):
+            if parent >= 0:
+                children[parent].append(v)
+        return cls._from_children(0, children.__getitem__, attributes.__getitem__, labels, transform)
+
+    def __len__(self) -> int:
+        return len(self._parent)
+
+    def get_root(self) -> int:
+        return 0
+
+    def get_parent(self) -> np.ndarray:
+        return self._parent
+
+    def get_offsets(self) -> np.ndarray:
+        return self._offsets
+
+    def get_children(self, v: int) -> np.ndarray:
+        return self._children[self._offsets[v]:self._offsets[v + 1]]
+
+    def get_out_degrees(self) -> np.ndarray:
+        return np.diff(self._offsets)
+
+    def is_leaf(self, v: int) -> bool:
+        return self._offsets[v] == self._offsets[v + 1]
+
+    def get_events(self) -> np.ndarray:
+        return self._events
+
+    def get_label_table(self) -> LabelTable:
+        return self._labels
+
+    def get_label_ids(self) -> np.ndarray:
+        return self._label_ids
+
+    def get_label(self, v: int):
+        return self._attribute(self._label_ids, v)
+
+    def get_attributes(self, v: int) -> dict:
+        """
+        Return the attributes of node v, as the node dictionary of the original graph.
+        """
+        attributes = {}
+        for attribute, column in (('label', self._label_ids), ('node_id', self._node_ids), ('species', self._species)):
+            if column[v] >= 0:
+                attributes[attribute] = self._labels.get_value(column[v])
+        attributes.update(self._extras.get(v, {}))
+        return attributes
+
+    def _attribute(self, column: np.ndarray, v: int):
+        return self._labels.get_value(column[v]) if column[v] >= 0 else None
+
+    def get_subtree_ends(self) -> np.ndarray:
+        """
+        Return end[v] such that the subtree of v is the preorder range [v, end[v]).
+        """
+        if self._ends is None:
+            ends = np.arange(1, len(self) + 1, dtype=np.int32)
+            parent = self._parent
+            for v in range(len(self) - 1, 0, -1):  # Children come after their parent in preorder
+                if ends[v] > ends[parent[v]]:
+                    ends[parent[v]] = ends[v]
+            self._ends = ends
+        return self._ends
+
+    def get_leaves(self, v: int | None = None) -> np.ndarray:
+        """
+        Return the leaves of the whole tree, or of the subtree of v, in preorder.
+        """
+        degrees = self.get_out_degrees()
+        if v is None:
+            return np.flatnonzero(degrees == 0)
+        end = self.get_subtree_ends()[v]
+        return v + np.flatnonzero(degrees[v:end] == 0)
+
+    def get_polytomies(self) -> list[int]:
+        """
+        Return the nodes with more than two children, like Utils.get_polytomies.
+        """
+        return np.flatnonzero(self.get_out_degrees() > 2).tolist()
+
+    def induced_labels(self, v: int) -> list:
+        """
+        Return the distinct leaf labels below v, exactly as list(induced_colors(tree, v, 'label')) does (same set,
+        built in the same order).
+        """
+        labels = set()
+        for leaf in self.get_leaves(v)[::-1].tolist():  # induced_leafs visits the last child first
+            labels.add(self.get_label(leaf))
+        return list(labels)
+
+    def to_graph(self) -> nx.DiGraph:
+        """
+        Convert back into a revolutionhtl-style networkx.DiGraph (node v keeps the number v; root attribute set).
+        """
+        T = nx.DiGraph()
+        for v in range(len(self)):
+            T.add_node(v, **self.get_attributes(v))
+        for v in range(len(self)):
+            T.add_edges_from((v, child) for child in self.get_children(v).tolist())
+        T.root = 0
+        return T
+
+    def splice(self, resolutions: dict[int, NJTree], event: str | None = None) -> "CompactTree":
+        """
+        Return a new tree where every polytomy x in resolutions is resolved with resolutions[x], with the same
+        topology and attributes Utils.update_tree_with_newick gives, one polytomy at a time, from the Newick text of
+        each NJTree on the equivalent graph. All splices refer to the node numbers of this tree; the result is
+        renumbered in preorder once, at the end.
+
+        :param resolutions: NJTree of each polytomy node; its taxa are the string form of the children of the node.
+        :param event: If given, 'event' attribute of the inserted nodes (custom_tree, for instance, marks every node
+            'S').
+        """
+        inserted = {} if event is None else {'event': event}
+        children: dict[int, list[int]] = {v: self.get_children(v).tolist() for v in range(len(self))}
+        attributes: dict[int, dict] = {}
+        next_node = len(self)
+
+        for node, nj_tree in resolutions.items():
+            taxa, nj_children = nj_tree.get_taxa(), nj_tree.get_children()
+            m = len(taxa)
+
+            def add_subtree(clade: int | str) -> int:
+                # Same shape as add_newick_edges in Utils.update_tree_with_newick; numbering does not matter here
+                nonlocal next_node
+                if isinstance(clade, str) or clade < m:
+                    return int(clade if isinstance(clade, str) else taxa[clade])
+                top = next_node
+                next_node += 1
+                stack = [(top, clade)]
+                while stack:
+                    internal_node, nj_node = stack.pop()
+                    children[internal_node] = []
+                    attributes[internal_node] = dict(inserted)
+                    for child in nj_children[nj_node - m].tolist():
+                        if child < m:
+                            children[internal_node].append(int(taxa[child]))
+                        else:
+                            children[internal_node].append(next_node)
+                            stack.append((next_node, child))
+                            next_node += 1
+                return top
+
+            if not taxa:
+                clades = list(nj_tree.get_disconnected_nodes())
+            elif nj_tree.get_disconnected_nodes():
+                clades = [nj_tree.get_root()] + list(nj_tree.get_disconnected_nodes())
+            else:
+                clades = nj_children[-1].tolist()
+
+            # Same handling of the root clades as Utils.update_tree_with_newick: the first one under node, the
+            # children of the second under a new 'D' node, the others dropped
+            children[node] = []
+            if len(clades) >= 1:
+                children[node].append(add_subtree(clades[0]))
+            if len(clades) > 1:
+                d_node = next_node
+                next_node += 1
+                children[node].append(d_node)
+                children[d_node] = []
+                attributes[d_node] = {'label': 'D', 'node_id': None, 'species': None, **inserted}
+                second = clades[1]
+                if not isinstance(second, str) and second >= m:
+                    children[d_node] = [add_subtree(child) for child in nj_children[second - m].tolist()]
+
+        return CompactTree._from_children(
+            0, lambda v: children.get(v, []),
+            lambda v: attributes.get(v, {}) if v >= len(self) else self.get_attributes(v), self._labels
+        )
+
+    def get_triplets(self, loss_leafs=LOSS_LABEL):
+        """
+        Yield the triplets (b, c, a) of the tree -- b and c the ingroup, sorted, and a the outgroup -- exactly as
+        Utils.get_triplets does on the equivalent graph with the labels as colors: only speciation nodes (event 'S')
+        are roots of triplets, and leaves labelled loss_leafs are ignored.
+        """
+        I: dict[int, set] = {}
+        for v in range(len(self) - 1, -1, -1):  # Reverse preorder: children before parents
+            children = self.get_children(v).tolist()
+            if not children:
+                label = self.get_label(v)
+                I[v] = set() if label == loss_leafs else {label}
+                continue
+            if v != 0:
+                I[v] = set(chain.from_iterable(I[child] for child in children))
+            if self._events[v] == EVENT_SPECIATION:
+                for x0, x1 in combinations(children, 2):
+                    for x_out, x_in in ((x0, x1), (x1, x0)):
+                        for a, (b, c) in product(I[x_out], combinations(I[x_in], 2)):
+                            if len({a, b, c}) == 3:
+                                yield tuple(sorted((b, c))) + (a,)
@@ -0,0 +1,339 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+_STORE_FORMAT = 2
+_MANIFEST_FILE = "manifest.json"
+_BLOCKS_DIR = "blocks"
+
+
+def id_prefix(gene_id: str) -> str:
+    """
+    Return the dataset/orthogroup prefix of a gene ID, e.g. 'noD_5_10_10_4' for 'noD_5_10_10_4|G0_0'.
+    IDs without a '|' separator share the empty prefix.
+    """
+    return gene_id.split('|')[0] if '|' in gene_id else ''
+
+
+def _save_replacing(file_path: str, array: np.ndarray) -> None:
+    # Write to a new file and swap it in, so processes that still map the old one keep valid data
+    with open(file_path + ".tmp", 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + ".tmp", file_path)
+
+
+class _BlockFileLoader:
+    """
+    Loads the b-th block of a store saved in path (a class rather than a closure, so loaded stores stay picklable).
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def __call__(self, b: int) -> "DistanceBlock":
+        ids = np.load(os.path.join(self._path, _BLOCKS_DIR, f"{b}.ids.npy")).tolist()
+        matrix = np.empty((0, 0))
+        if ids:
+            matrix = np.load(os.path.join(self._path, _BLOCKS_DIR, f"{b}.npy"), mmap_mode='r')
+        return DistanceBlock(ids, matrix)
+
+
+class DistanceBlock:
+    """
+    Dense, NaN-filled, symmetric distance matrix between the gene IDs of one prefix.
+    """
+
+    def __init__(self, ids: list[str], matrix: np.ndarray):
+        self._ids = ids
+        self._index: dict[str, int] = {gene_id: idx for idx, gene_id in enumerate(ids)}
+        self._matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def get_ids(self) -> list[str]:
+        return self._ids
+
+    def get_matrix(self) -> np.ndarray:
+        return self._matrix
+
+    def get_index(self, gene_id: str) -> int:
+        return self._index.get(gene_id, -1)
+
+    def get_indices(self, gene_ids: list[str]) -> np.ndarray:
+        get = self._index.get
+        return np.fromiter((get(gene_id, -1) for gene_id in gene_ids), dtype=np.int64, count=len(gene_ids))
+
+
+class DistanceStore:
+    """
+    Pairwise distances between gene IDs, partitioned into one dense symmetric block per ID prefix.
+
+    Inside a block, gene IDs are mapped once to dense integer indices and pairs live in a NaN-filled matrix, which
+    gives O(1) scalar lookups and lets whole index blocks be gathered with a single fancy-indexing operation. Pairs
+    whose IDs share a prefix are the usual case, since hits are computed inside a simulation/orthogroup; the few that
+    cross prefixes are kept in a small dictionary.
+
+    A store loaded from disk only reads the prefix table up front. Each block is loaded (memory-mapped) the first
+    time one of its IDs is looked up and can be dropped again with release(), so the memory in use is bounded by the
+    blocks the caller is working on rather than by the whole hit set.
+
+    Missing pairs are reported as np.nan, exactly like ``pandas.Series.get(pair, np.nan)`` on the frozenset-indexed
+    Series returned by ``Utils.load_hits_compute_distance_pairs``.
+    """
+
+    def __init__(
+            self, prefixes: list[str], sizes: np.ndarray, blocks: list[DistanceBlock | None],
+            cross: dict[tuple[str, str], float], block_loader=None
+    ):
+        self._prefixes = prefixes
+        self._block_index: dict[str, int] = {prefix: b for b, prefix in enumerate(prefixes)}
+        self._sizes = sizes
+        self._blocks = blocks
+        self._cross = cross
+        self._block_loader = block_loader
+        # prefixes = [p_0, p_1, ...]        block number -> prefix
+        # sizes[b] = n                      number of IDs in block b
+        # blocks[b] = DistanceBlock | None  None while a block that block_loader(b) can provide is not loaded
+        # cross = {(z_i, z_j): d, ...}      pairs of IDs with different prefixes, z_i < z_j
+
+    @classmethod
+    def from_pairs(cls, ids_a, ids_b, values) -> "DistanceStore":
+        """
+        Build a store from three parallel sequences describing undirected pairs (a, b) -> distance.
+
+        :param ids_a: Sequence of gene IDs.
+        :param ids_b: Sequence of gene IDs (a == b sets the self-distance).
+        :param values: Sequence of distances; later duplicates of a pair overwrite earlier ones.
+        :return: A DistanceStore.
+        """
+        ids_a = np.asarray(ids_a, dtype=object)
+        ids_b = np.asarray(ids_b, dtype=object)
+        values = np.asarray(values, dtype=float)
+
+        codes, unique_ids = pd.factorize(np.concatenate((ids_a, ids_b)))
+        ia, ib = codes[:len(ids_a)], codes[len(ids_a):]
+
+        ids: list[str] = unique_ids.tolist()
+        prefixes, block_of = np.unique([id_prefix(gene_id) for gene_id in ids], return_inverse=True)
+        block_of = block_of.astype(np.int64)
+        sizes = np.bincount(block_of, minlength=len(prefixes))
+
+        # Local position of every ID inside its block (blocks keep the global order)
+        order = np.argsort(block_of, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        local = np.empty(len(ids), dtype=np.int64)
+        local[order] = np.arange(len(ids)) - starts[block_of[order]]
+
+        # Fill each block with one fancy assignment; (a, b) and (b, a) are interleaved so later pairs still win
+        matrices = [np.full((size, size), np.nan) for size in sizes]
+        same = block_of[ia] == block_of[ib]
+        entries = np.flatnonzero(same)
+        entries = entries[np.argsort(block_of[ia[entries]], kind='stable')]
+        block_bounds = np.searchsorted(block_of[ia[entries]], np.arange(len(prefixes) + 1))
+        for b, matrix in enumerate(matrices):
+            e = entries[block_bounds[b]:block_bounds[b + 1]]
+            if len(e):
+                la, lb = local[ia[e]], local[ib[e]]
+                matrix[np.column_stack((la, lb)).ravel(), np.column_stack((lb, la)).ravel()] = np.repeat(values[e], 2)
+
+        blocks = [
+            DistanceBlock([ids[i] for i in order[start:start + size]], matrix)
+            for start, size, matrix in zip(starts, sizes, matrices)
+        ]
+
+        cross = {}
+        for i, j, value in zip(ia[~same].tolist(), ib[~same].tolist(), values[~same].tolist()):
+            cross[(ids[i], ids[j]) if ids[i] < ids[j] else (ids[j], ids[i])] = value
+
+        return cls(prefixes.tolist(), sizes, blocks, cross)
+
+    @classmethod
+    def from_series(cls, distance_pairs_series: pd.Series) -> "DistanceStore":
+        """
+        Build a store from the frozenset-indexed Series returned by ``Utils.load_hits_compute_distance_pairs``.
+
+        :param distance_pairs_series: pandas Series where the index is frozensets of leaf pairs.
+        :return: A DistanceStore with the same pairs and distances.
+        """
+        pairs = [tuple(pair) if len(pair) == 2 else 2 * tuple(pair) for pair in distance_pairs_series.index]
+        ids_a = [a for a, _ in pairs]
+        ids_b = [b for _, b in pairs]
+        return cls.from_pairs(ids_a, ids_b, distance_pairs_series.to_numpy(dtype=float))
+
+    def save(self, path: str, metadata: dict | None = None) -> None:
+        """
+        Persist the store in a directory, partitioned by prefix: blocks/<b>.npy holds the distance matrix of the
+        b-th prefix and blocks/<b>.ids.npy its IDs. The prefix table, the cross-prefix pairs and a manifest.json
+        (written last) sit at the top level.
+
+        :param path: Directory to write to (created if needed; previous content is overwritten).
+        :param metadata: Extra JSON-serializable information stored in the manifest (e.g. the hits fingerprint).
+        """
+        blocks_path = os.path.join(path, _BLOCKS_DIR)
+        os.makedirs(blocks_path, exist_ok=True)
+        manifest_path = os.path.join(path, _MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)  # Invalidate the directory while it is being rewritten
+
+        written = set()
+        for b in range(len(self._prefixes)):
+            block = self._get_block(b)
+            for name, array in ((f"{b}.ids.npy", np.array(block.get_ids(), dtype=str)),
+                                (f"{b}.npy", np.ascontiguousarray(block.get_matrix(), dtype=np.float64))):
+                _save_replacing(os.path.join(blocks_path, name), array)
+                written.add(name)
+        for name in set(os.listdir(blocks_path)) - written:
+            os.remove(os.path.join(blocks_path, name))
+
+        cross_ids = np.array(list(self._cross.keys()), dtype=str).reshape(-1, 2)
+        _save_replacing(os.path.join(path, "prefixes.npy"), np.array(self._prefixes, dtype=str))
+        _save_replacing(os.path.join(path, "sizes.npy"), np.asarray(self._sizes, dtype=np.int64))
+        _save_replacing(os.path.join(path, "cross_ids.npy"), cross_ids)
+        _save_replacing(os.path.join(path, "cross_values.npy"), np.array(list(self._cross.values()), dtype=float))
+
+        DistanceStore.write_metadata(path, metadata)
+
+    @staticmethod
+    def write_metadata(path: str, metadata: dict | None = None) -> None:
+        """
+        (Re)write the manifest of a saved store; its presence marks the directory as a complete store.
+        """
+        with open(os.path.join(path, _MANIFEST_FILE), 'w') as f:
+            json.dump({"format": _STORE_FORMAT, "metadata": metadata or {}}, f)
+
+    @staticmethod
+    def read_metadata(path: str) -> dict | None:
+        """
+        Return the metadata saved with a store, or None if path does not hold a complete store of this format.
+        """
+        try:
+            with open(os.path.join(path, _MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get("format") != _STORE_FORMAT:
+            return None
+        return manifest.get("metadata", {})
+
+    @classmethod
+    def load(cls, path: str) -> "DistanceStore":
+        """
+        Open a store written by save(). Only the prefix table and the cross-prefix pairs are read now; every block
+        is loaded on first use, with its distances memory-mapped read-only.
+        """
+        prefixes = np.load(os.path.join(path, "prefixes.npy")).tolist()
+        sizes = np.load(os.path.join(path, "sizes.npy"))
+        cross = {
+            (a, b): float(value)
+            for (a, b), value in zip(np.load(os.path.join(path, "cross_ids.npy")).tolist(),
+                                     np.load(os.path.join(path, "cross_values.npy")))
+        }
+
+        return cls(prefixes, sizes, [None] * len(prefixes), cross, block_loader=_BlockFileLoader(path))
+
+    def _get_block(self, b: int) -> DistanceBlock:
+        if self._blocks[b] is None:
+            self._blocks[b] = self._block_loader(b)
+        return self._blocks[b]
+
+    def release(self) -> None:
+        """
+        Drop every block that can be loaded again from disk (a no-op for stores built in memory).
+        """
+        if self._block_loader is not None:
+            self._blocks = [None] * len(self._prefixes)
+
+    def restrict(self, prefixes: list[str]) -> "DistanceStore":
+        """
+        Return an in-memory store holding only the blocks of the given prefixes (and the cross pairs among them).
+        """
+        keep = [prefix for prefix in dict.fromkeys(prefixes) if prefix in self._block_index]
+        blocks = [self._get_block(self._block_index[prefix]) for prefix in keep]
+        sizes = np.array([len(block) for block in blocks], dtype=np.int64)
+        kept = set(keep)
+        cross = {
+            pair: d for pair, d in self._cross.items() if id_prefix(pair[0]) in kept and id_prefix(pair[1]) in kept
+        }
+        return DistanceStore(keep, sizes, blocks, cross)
+
+    def __len__(self) -> int:
+        return int(np.sum(self._sizes))
+
+    def __contains__(self, gene_id: str) -> bool:
+        b = self._block_index.get(id_prefix(gene_id))
+        return b is not None and self._get_block(b).get_index(gene_id) >= 0
+
+    def get_prefixes(self) -> list[str]:
+        return self._prefixes
+
+    def get_ids(self) -> list[str]:
+        return [gene_id for b in range(len(self._prefixes)) for gene_id in self._get_block(b).get_ids()]
+
+    def get_block(self, prefix: str) -> tuple[list[str], np.ndarray]:
+        """
+        Return the IDs and the dense distance matrix stored for one prefix.
+        """
+        block = self._get_block(self._block_index[prefix])
+        return block.get_ids(), block.get_matrix()
+
+    def distance(self, leaf_1: str, leaf_2: str) -> float:
+        """
+        O(1) lookup of the distance between two gene IDs.
+
+        :return: The distance if the pair is present, else np.nan.
+        """
+        prefix = id_prefix(leaf_1)
+        if prefix != id_prefix(leaf_2):
+            return self._cross.get((leaf_1, leaf_2) if leaf_1 < leaf_2 else (leaf_2, leaf_1), np.nan)
+
+        b = self._block_index.get(prefix)
+        if b is None:
+            return np.nan
+        block = self._get_block(b)
+        i, j = block.get_index(leaf_1), block.get_index(leaf_2)
+        if i < 0 or j < 0:
+            return np.nan
+        return block.get_matrix()[i, j]
+
+    def get(self, pair: frozenset, default=np.nan) -> float:
+        """
+        pandas.Series-compatible lookup by frozenset pair, so a store can replace the Series anywhere.
+        """
+        pair = tuple(pair)
+        value = self.distance(pair[0], pair[-1])
+        return default if np.isnan(value) else value
+
+    def submatrix(self, rows: list[str], cols: list[str] | None = None) -> np.ndarray:
+        """
+        Bulk lookup of all distances between two lists of gene IDs.
+
+        :param rows: Gene IDs for the rows.
+        :param cols: Gene IDs for the columns (defaults to rows).
+        :return: len(rows) x len(cols) array; missing pairs are np.nan.
+        """
+        cols = rows if cols is None else cols
+        row_prefixes = np.array([id_prefix(gene_id) for gene_id in rows], dtype=object)
+        col_prefixes = np.array([id_prefix(gene_id) for gene_id in cols], dtype=object)
+        out = np.full((len(rows), len(cols)), np.nan)
+
+        for prefix in dict.fromkeys(row_prefixes.tolist()):
+            b = self._block_index.get(prefix)
+            c_sel = np.flatnonzero(col_prefixes == prefix)
+            if b is None or not c_sel.size:
+                continue
+            r_sel = np.flatnonzero(row_prefixes == prefix)
+            block = self._get_block(b)
+            ri = block.get_indices([rows[i] for i in r_sel])
+            ci = block.get_indices([cols[j] for j in c_sel])
+            r_ok, c_ok = ri >= 0, ci >= 0
+            out[np.ix_(r_sel[r_ok], c_sel[c_ok])] = block.get_matrix()[np.ix_(ri[r_ok], ci[c_ok])]
+
+        if self._cross and len(set(row_prefixes.tolist()) | set(col_prefixes.tolist())) > 1:
+            for i, j in np.argwhere(row_prefixes[:, None] != col_prefixes[None, :]):
+                a, b = rows[i], cols[j]
+                out[i, j] = self._cross.get((a, b) if a < b else (b, a), np.nan)
+
+        return out
@@ -0,0 +1,242 @@
+import os
+import csv
+import json
+from time import perf_counter
+
+# Per-process stage timings and counters, keyed by OG. Disabled (None) unless enable() is called: every hook then
+# returns after one global check, so the calls can stay in the hot paths.
+_records: dict | None = None    # {og: {'stages': {name: seconds}, 'counters': {name: value}}}
+_og = None                      # OG the hooks record to when no og is given
+_owners: list | None = None     # OG of every item of the batch call in progress (see owners)
+
+RUN = 'run'                     # Key of the record of everything not tied to one OG
+_CURRENT = object()             # Default og argument: the current OG, else RUN
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullStage":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        return None
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ('_name', '_ogs', '_start')
+
+    def __init__(self, name: str, ogs: list):
+        self._name = name
+        self._ogs = ogs  # The elapsed time is split evenly among them
+
+    def __enter__(self) -> "_Stage":
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        share = (perf_counter() - self._start) / len(self._ogs)
+        for og in self._ogs:
+            stages = _record(og)['stages']
+            stages[self._name] = stages.get(self._name, 0.0) + share
+
+
+def _accumulate(values: dict, name: str, value: int | float) -> None:
+    # Sum, except for the peak counters ('max_*'), which keep the largest value
+    if name.startswith('max_'):
+        values[name] = max(values.get(name, value), value)
+    else:
+        values[name] = values.get(name, 0) + value
+
+
+def _record(og) -> dict:
+    if og is _CURRENT:
+        og = RUN if _og is None else _og
+    record = _records.get(og)
+    if record is None:
+        record = _records[og] = {'stages': {}, 'counters': {}}
+    return record
+
+
+def enable() -> None:
+    global _records, _og
+    _records, _og = {}, None
+
+
+def disable() -> None:
+    global _records, _og
+    _records, _og = None, None
+
+
+def enabled() -> bool:
+    return _records is not None
+
+
+def set_og(og) -> None:
+    """
+    Make og the OG the following hooks record to (None: the run record).
+    """
+    global _og
+    _og = og
+
+
+def stage(name: str, og=_CURRENT) -> _Stage | _NullStage:
+    """
+    Context manager that adds the time spent in its block to the stage name of og (default: the current OG).
+    """
+    if _records is None:
+        return _NULL_STAGE
+    return _Stage(name, [og])
+
+
+def shared_stage(name: str, items: list[int]) -> _Stage | _NullStage:
+    """
+    Stage of a batch call that serves several items at once (e.g. one NJ run for many polytomies): its time is split
+    evenly among the items, each one going to its OG as set by owners, else to the current OG.
+    """
+    if _records is None or not items:
+        return _NULL_STAGE
+    return _Stage(name, [_owners[item] if _owners is not None else _CURRENT for item in items])
+
+
+class _Owners:
+    __slots__ = ('_ogs',)
+
+    def __init__(self, ogs: list):
+        self._ogs = ogs
+
+    def __enter__(self) -> "_Owners":
+        global _owners
+        if _records is not None:
+            _owners = self._ogs
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        global _owners
+        _owners = None
+
+
+def owners(ogs: list) -> _Owners:
+    """
+    Context manager that tells shared_stage the OG of every item (by index) of the batch calls in its block.
+    """
+    return _Owners(ogs)
+
+
+def count(name: str, value: int | float = 1, og=_CURRENT) -> None:
+    """
+    Add value to the counter name of og (default: the current OG).
+    """
+    if _records is None:
+        return
+    counters = _record(og)['counters']
+    counters[name] = counters.get(name, 0) + value
+
+
+def peak(name: str, value: int | float, og=_CURRENT) -> None:
+    """
+    Keep in the counter name of og the largest value it is given. Name it 'max_*', so that merge and write also
+    keep the largest value instead of a sum.
+    """
+    if _records is None:
+        return
+    counters = _record(og)['counters']
+    counters[name] = max(counters.get(name, value), value)
+
+
+def drain() -> dict:
+    """
+    Return the records collected so far in this process and start new ones (e.g. at the end of a worker task).
+    """
+    global _records
+    records = _records or {}
+    if _records is not None:
+        _records = {}
+    return records
+
+
+def merge(records: dict) -> None:
+    """
+    Add the records of another process (see drain) to those of this one: stages and counters are summed, except
+    the peak counters (named 'max_*'), which keep the largest value.
+    """
+    if _records is None:
+        return
+    for og, record in records.items():
+        target = _record(og)
+        for kind in ('stages', 'counters'):
+            for name, value in record[kind].items():
+                _accumulate(target[kind], name, value)
+
+
+def sidecar_paths(output_file: str) -> tuple[str, str]:
+    """
+    Files written by write next to output_file: results.tsv -> results_instrumentation.tsv and .json.
+    """
+    base = os.path.splitext(output_file)[0]
+    return f"{base}_instrumentation.tsv", f"{base}_instrumentation.json"
+
+
+def write(output_file: str) -> None:
+    """
+    Write the records next to output_file (see sidecar_paths): a TSV with one row per OG (og, the seconds of every
+    stage, then every counter; empty when an OG has none) and a JSON with the run record and the totals over OGs.
+    """
+    records = _records or {}
+    ogs = sorted(og for og in records if og != RUN)
+    stages = list(dict.fromkeys(name for og in ogs for name in records[og]['stages']))
+    counters = list(dict.fromkeys(name for og in ogs for name in records[og]['counters']))
+
+    tsv_file, json_file = sidecar_paths(output_file)
+    with open(tsv_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['og'] + [f"{name}_seconds" for name in stages] + counters)
+        for og in ogs:
+            record = records[og]
+            writer.writerow([og] + [record['stages'].get(name, '') for name in stages]
+                            + [record['counters'].get(name, '') for name in counters])
+
+    totals = {'stages': {}, 'counters': {}}
+    for og in ogs:
+        for kind in ('stages', 'counters'):
+            for name, value in records[og][kind].items():
+                _accumulate(totals[kind], name, value)
+    with open(json_file, 'w') as f:
+        json.dump({'run': records.get(RUN, {'stages': {}, 'counters': {}}), 'ogs': len(ogs), 'totals': totals}, f,
+                  indent=1)
+
+
+def merge_sidecars(shard_output_files: list[str], output_file: str) -> None:
+    """
+    Combine the files write wrote next to the output files of several runs over disjoint OGs (e.g. the shards of
+    one run) into those of output_file: the per-OG rows in OG order, with the union of their columns, and the run
+    records and totals added up (see merge).
+    """
+    columns: dict[str, None] = {}
+    rows: list[dict] = []
+    summary = {'run': {'stages': {}, 'counters': {}}, 'ogs': 0, 'totals': {'stages': {}, 'counters': {}}}
+    for shard_output_file in shard_output_files:
+        tsv_file, json_file = sidecar_paths(shard_output_file)
+        with open(tsv_file, newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            columns.update(dict.fromkeys(reader.fieldnames or []))
+            rows.extend(reader)
+        with open(json_file) as f:
+            shard_summary = json.load(f)
+        summary['ogs'] += shard_summary['ogs']
+        for part in ('run', 'totals'):
+            for kind in ('stages', 'counters'):
+                for name, value in shard_summary[part][kind].items():
+                    _accumulate(summary[part][kind], name, value)
+
+    rows.sort(key=lambda row: int(row['og']))
+    tsv_file, json_file = sidecar_paths(output_file)
+    with open(tsv_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(columns), delimiter='\t', restval='')
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(json_file, 'w') as f:
+        json.dump(summary, f, indent=1)
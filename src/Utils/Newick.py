@@ -0,0 +1,147 @@
+import re
+import networkx as nx
+from itertools import chain
+
+# Tokens of the 'label[node_id=...;species=...]' dialect: structure symbols, an NHX comment, a branch length, a name
+_TOKEN = re.compile(r'[(),;]|\[[^\]]*\]|:[^(),;\[]*|[^(),;:\[]+')
+
+
+def parse_nhx(nhx: str, name_attr: str = 'label') -> tuple[list[int], list[dict]]:
+    """
+    Single-pass tokenizer parser of an NHX string: return parent[v] (-1 for the root) and the attributes of every
+    node v, numbered exactly as revolutionhtl.nhxx_tools.read_nhxx numbers them (a dummy root 0, then the nodes in
+    order of appearance, i.e. preorder) and with the same attributes: name_attr (the node number when a node has no
+    name), 'length' (float) when a branch length is given, the NHX key=value pairs as strings, and None for every
+    attribute some other node has.
+
+    :param nhx: NHX string, ending with ';'.
+    :param name_attr: Attribute that receives the node names.
+    """
+    parents: list[int] = [-1]
+    attributes: list[dict] = [{name_attr: 0}]
+    stack: list[int] = [0]   # Open inner nodes
+    current, last = 0, None  # Node being read; last structure symbol seen
+    name, length, extra = None, None, {}
+
+    for token in _TOKEN.findall(nhx):
+        symbol = token[0]
+        if symbol == '(':
+            parents.append(current)
+            attributes.append({})
+            current = len(parents) - 1
+            stack.append(current)
+        elif symbol in ',);':
+            # End of node
+            attributes[current] = {name_attr: current if name is None else name}
+            if length is not None:
+                attributes[current]['length'] = float(length)
+            attributes[current].update(extra)
+            name, length, extra = None, None, {}
+            if symbol == ',':
+                current = stack[-1]
+            elif symbol == ')':
+                current = stack.pop()
+            else:
+                stack.pop()
+                break
+        elif symbol == '[':
+            for item in token[1:-1].split(';'):
+                if item:
+                    key, *values = item.split('=')
+                    extra[key] = values[-1] if values else None
+        elif symbol == ':':
+            length = token[1:]
+        else:
+            if last != ')':  # A name that does not follow ')' starts a leaf
+                parents.append(current)
+                attributes.append({})
+                current = len(parents) - 1
+            name = token
+            continue
+        last = symbol
+
+    if stack:
+        raise ValueError(f'";" found before closing all the parenthesis: {stack}')
+
+    # Fill the attributes missing from some nodes with None
+    keys = set(chain.from_iterable(attributes))
+    for node_attributes in attributes:
+        for key in keys - node_attributes.keys():
+            node_attributes[key] = None
+
+    return parents, attributes
+
+
+def read_nhx(nhx: str, name_attr: str = 'label') -> nx.DiGraph:
+    """
+    Drop-in replacement of revolutionhtl.nhxx_tools.read_nhxx for the trees of this project: the same nodes, edges
+    (children in order) and attributes, and the root attribute. The LCA tables read_nhxx also attaches to the graph
+    (T.E, T.st, ...) are not built; nothing here uses them.
+    """
+    parents, attributes = parse_nhx(nhx, name_attr)
+    T = nx.DiGraph()
+    T.add_nodes_from(enumerate(attributes))
+    T.add_edges_from((parent, v) for v, parent in enumerate(parents) if parent >= 0)
+    T.root = 0
+    return T
+
+
+def write_nhx(T: nx.DiGraph, root=None) -> str:
+    """
+    Write the subtree of root in the canonical 'label[node_id=...;species=...]' dialect, attributes always in that
+    order: the string Utils.transform_newick(get_nhx(T, root, name_attr='label')) gives, in one pass and without the
+    regex. Like it, a node with no attribute but its label (e.g. the dummy root 0) gets no brackets.
+
+    :param root: Root node; defaults to T.root (as get_nhx, also when root is 0).
+    """
+    root = root or T.root
+    newick: dict = {}
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        children = list(T.successors(node))
+        if children and not expanded:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(children))
+            continue
+
+        text = '(' + ','.join([newick.pop(child) for child in children]) + ')' if children else ''
+        attributes = T.nodes[node]
+        label, node_id, species = (attributes.get(key) for key in ('label', 'node_id', 'species'))
+        text += '' if label is None else str(label)
+        if any(value is not None for key, value in attributes.items() if key != 'label'):
+            text += f"[node_id={'' if node_id is None else node_id}"
+            if species is not None and str(species):
+                text += f";species={species}"
+            text += "]"
+        newick[node] = text
+
+    return newick[root] + ';'
+
+
+def test_read_nhx() -> None:
+    from revolutionhtl.nhxx_tools import read_nhxx, get_nhx
+    from src.Utils.Utils import transform_newick
+
+    examples = [
+        "(noD_5_0_10_0|G1_2[node_id=1;species=H2],noD_5_0_10_0|G0_1[node_id=0;species=H1])S[node_id=2];",
+        "((a[node_id=0;species=H0],b[node_id=1],X[node_id=5])D[node_id=4],c[species=H2;node_id=2])S[node_id=3];",
+        "((1:0.5,2:0.25):0.125,3:0,4:nan)X;",
+        "(((A,B),(C,D,E)),F);",
+    ]
+
+    def attributes(T: nx.DiGraph) -> list:
+        return [sorted((key, repr(value)) for key, value in T.nodes[v].items()) for v in T]  # repr: NaN == NaN
+
+    same = 0
+    for nhx in examples:
+        expected, tree = read_nhxx(nhx), read_nhx(nhx)
+        same_graph = list(expected.edges) == list(tree.edges) and attributes(expected) == attributes(tree)
+        same_text = write_nhx(tree) == transform_newick(get_nhx(expected, name_attr='label'))
+        same += same_graph and same_text
+        print(f"{nhx}\n\t{write_nhx(tree)}\n\tsame graph: {same_graph}, same text: {same_text}")
+    print(f"read_nhx == read_nhxx: {same}/{len(examples)}")
+
+
+if __name__ == "__main__":
+    test_read_nhx()
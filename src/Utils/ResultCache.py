@@ -0,0 +1,78 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+def result_key(*parts: str | bytes | np.ndarray | dict) -> str:
+    """
+    Return the SHA-1 of a sequence of inputs (text, raw bytes, arrays or JSON-serializable settings), each one
+    length-prefixed so that different splits of the same bytes give different keys.
+    """
+    sha1 = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part).tobytes()
+        elif isinstance(part, dict):
+            part = json.dumps(part, sort_keys=True)
+        if isinstance(part, str):
+            part = part.encode()
+        sha1.update(len(part).to_bytes(8, 'little'))
+        sha1.update(part)
+    return sha1.hexdigest()
+
+
+class ResultCache:
+    """
+    Append-only checkpoint of result rows keyed by result_key, one 'key<TAB>JSON row' line per row.
+
+    Every row is written and flushed as soon as it is put, so a run that stops half-way keeps all the rows it
+    produced; a truncated last line (a crash in the middle of a write) is ignored on the next open. When a key is
+    put twice, the last row wins.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._rows: dict[str, list] = {}
+        complete = True  # Whether the file ends with a full line
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    complete = line.endswith('\n')
+                    key, _, row = line.rstrip('\n').partition('\t')
+                    try:
+                        self._rows[key] = json.loads(row)
+                    except ValueError:
+                        continue
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'a')
+        if not complete:
+            self._file.write('\n')  # Keep the next row off the truncated line
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._rows
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get_rows(self) -> dict[str, list]:
+        return self._rows
+
+    def get(self, key: str) -> list | None:
+        return self._rows.get(key)
+
+    def put(self, key: str, row: list) -> None:
+        self._file.write(f"{key}\t{json.dumps(row)}\n")
+        self._file.flush()
+        self._rows[key] = row
+
+    def close(self) -> None:
+        self._file.close()
@@ -0,0 +1,102 @@
+import os
+import csv
+import heapq
+import hashlib
+import src.Utils.Utils as utils
+
+# How the OGs are split between shards
+SHARD_PLAN_HASH = "hash"            # By a stable hash of the OG number: no extra pass, balanced on average
+SHARD_PLAN_BALANCED = "balanced"    # Greedy longest-first over an estimated cost per tree: balanced in work
+SHARD_PLANS = (SHARD_PLAN_HASH, SHARD_PLAN_BALANCED)
+
+
+def parse_shard(spec: str) -> tuple[int, int]:
+    """
+    Parse a shard spec 'i/N' (shard i of N, 0 <= i < N) into (i, N).
+    """
+    index, _, shards = spec.partition('/')
+    try:
+        index, shards = int(index), int(shards)
+    except ValueError:
+        raise ValueError(f"Invalid shard spec '{spec}', expected 'i/N'.") from None
+    if not 0 <= index < shards:
+        raise ValueError(f"Invalid shard spec '{spec}': i must be in [0, N).")
+    return index, shards
+
+
+def shard_file(path: str, index: int, shards: int) -> str:
+    """
+    File of shard index of shards for a file of the unsharded run: results.tsv -> results.shard_2_of_8.tsv.
+    """
+    base, extension = os.path.splitext(path)
+    return f"{base}.shard_{index}_of_{shards}{extension}"
+
+
+def hash_shard(og: int, shards: int) -> int:
+    """
+    Shard of an OG under SHARD_PLAN_HASH: the same on every machine and Python process (no hash randomization).
+    """
+    return int.from_bytes(hashlib.sha1(str(og).encode()).digest()[:8], 'big') % shards
+
+
+def estimated_cost(nhx: str) -> int:
+    """
+    Relative cost of resolving a tree, from its Newick string: the triplet scoring grows with the square of its
+    leaves and the NJ run of every polytomy with the cube of its degree.
+    """
+    return len(utils.newick_leaf_labels(nhx)) ** 2 + sum(degree ** 3 for degree in utils.newick_polytomy_degrees(nhx))
+
+
+def plan_shards(
+        trees_path: str, shards: int, plan: str = SHARD_PLAN_HASH, ogs: set[int] | None = None
+) -> list[set[int]]:
+    """
+    Split the OGs of a reconciliation TSV file between shards; every machine computes the same plan from the same
+    file. SHARD_PLAN_BALANCED only places the trees main.computations resolves (a polytomy and one leaf prefix) and
+    assigns them, most expensive first (ties by OG), to the shard with the least estimated work so far (ties by
+    shard); the other OGs produce no rows and go to no shard.
+
+    :param ogs: OGs to split, or None for all of them.
+    :return: The OGs of every shard.
+    """
+    if plan not in SHARD_PLANS:
+        raise ValueError(f"Unknown shard plan: {plan}. Expected one of {SHARD_PLANS}.")
+
+    planned: list[set[int]] = [set() for _ in range(shards)]
+    costs: list[tuple[int, int]] = []  # (-cost, og)
+    for og, nhx in utils.iter_newick_trees(trees_path):
+        if ogs is not None and og not in ogs:
+            continue
+        if plan == SHARD_PLAN_HASH:
+            planned[hash_shard(og, shards)].add(og)
+        elif utils.newick_leaf_prefix(nhx) is not None and utils.newick_has_polytomy(nhx):
+            costs.append((-estimated_cost(nhx), og))
+
+    loads = [(0, shard) for shard in range(shards)]  # Heap of (estimated work, shard)
+    for cost, og in sorted(costs):
+        load, shard = heapq.heappop(loads)
+        planned[shard].add(og)
+        heapq.heappush(loads, (load - cost, shard))
+    return planned
+
+
+def merge_tsv(shard_files: list[str], output_file: str) -> None:
+    """
+    Concatenate TSV files with the same header and an OG first column into output_file, rows sorted by OG.
+    """
+    header, rows = None, []
+    for file in shard_files:
+        with open(file, newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            file_header = next(reader, None)
+            if header is not None and file_header != header:
+                raise ValueError(f"Header of {file} differs from that of {shard_files[0]}.")
+            header = file_header
+            rows.extend(reader)
+
+    rows.sort(key=lambda row: int(row[0]))
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        if header is not None:
+            writer.writerow(header)
+        writer.writerows(rows)
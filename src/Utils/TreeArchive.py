@@ -0,0 +1,162 @@
+import os
+import re
+import mmap
+import json
+from typing import Iterator
+
+_ARCHIVE_FORMAT = 2
+_TREES_FILE = "trees.nhx"
+_INDEX_FILE = "index.json"
+_TREE_FILE_NAME = re.compile(r"^g(\d+_\d+_\d+_\d+)\.pruned\.tree$")  # ga_b_c_d.pruned.tree -> a_b_c_d
+
+
+def _tree_files(base_path: str) -> Iterator[tuple[str, str]]:
+    # (a_b_c_d, path relative to base_path) of every ga_b_c_d.pruned.tree file, in a fixed order
+    for folder in sorted(os.listdir(base_path)):
+        if not os.path.isdir(os.path.join(base_path, folder)):
+            continue
+        for file_name in sorted(os.listdir(os.path.join(base_path, folder))):
+            match = _TREE_FILE_NAME.match(file_name)
+            if match:
+                yield match.group(1), os.path.join(folder, file_name)
+
+
+def _source_stat(base_path: str, file: str) -> list[int]:
+    stat = os.stat(os.path.join(base_path, file))
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TreeArchive:
+    """
+    All the real gene trees in one flat file plus an offset index keyed by 'a_b_c_d', replacing the one small file
+    per tree of input/true_gene_trees/<a>_<b>_<c>_/g<a>_<b>_<c>_<d>.pruned.tree.
+
+    A tree is fetched with a single seek and read, or sliced from a memory map of the whole file (memory_map=True),
+    so a run opens one file instead of one per OG. Like a loaded DistanceStore, an archive pickles as its path only:
+    each worker process opens the file on its own. The index also records the size and mtime of every source file,
+    so that exists can tell, on request, an archive that no longer matches its tree files.
+    """
+
+    def __init__(self, path: str, index: dict[str, tuple[int, int]], memory_map: bool = False):
+        self._path = path
+        self._index = index
+        self._memory_map = memory_map
+        self._file = None
+        self._map: mmap.mmap | None = None
+        # index = {key: (offset, length), ...}     bytes of the tree of key in trees.nhx
+
+    @staticmethod
+    def pack(base_path: str, path: str) -> "TreeArchive":
+        """
+        Pack every ga_b_c_d.pruned.tree file under base_path into an archive in the directory path. The index is
+        written last, so a directory without it is never taken for a complete archive. Every file is stat-ed before
+        it is read, so one changed during the packing makes the archive stale rather than silently out of date.
+
+        :param base_path: Root folder of the real gene trees (e.g. 'input/true_gene_trees/').
+        :param path: Directory of the archive (created if needed; a previous archive there is replaced).
+        """
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, _INDEX_FILE)
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+        index = {}
+        sources = {}  # {path relative to base_path: [size, mtime_ns]}
+        offset = 0
+        with open(os.path.join(path, _TREES_FILE), 'wb') as archive:
+            for key, file in _tree_files(base_path):
+                sources[file] = _source_stat(base_path, file)
+                with open(os.path.join(base_path, file), 'rb') as f:
+                    newick = f.read().strip()
+                index[key] = (offset, len(newick))
+                archive.write(newick + b'\n')
+                offset += len(newick) + 1
+
+        with open(index_path, 'w') as f:
+            json.dump({"format": _ARCHIVE_FORMAT, "index": index, "sources": sources}, f)
+        return TreeArchive.load(path)
+
+    @staticmethod
+    def exists(path: str, base_path: str | None = None) -> bool:
+        """
+        Return whether path holds a complete archive of this format and, if base_path is given, one packed from the
+        tree files base_path has now: the same files, with the same sizes and mtimes. That check lists and stats every
+        tree file, the I/O the archive saves, so it belongs to the step that packs it rather than to every run.
+        """
+        try:
+            with open(os.path.join(path, _INDEX_FILE)) as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if metadata.get("format") != _ARCHIVE_FORMAT:
+            return False
+        if base_path is None:
+            return True
+        try:
+            sources = {file: _source_stat(base_path, file) for _, file in _tree_files(base_path)}
+        except OSError:
+            return False
+        return sources == metadata.get("sources")
+
+    @classmethod
+    def load(cls, path: str, memory_map: bool = False) -> "TreeArchive":
+        """
+        Open an archive written by pack(). Only the index is read now.
+
+        :param memory_map: Map the whole trees file instead of seeking into it for every tree.
+        """
+        with open(os.path.join(path, _INDEX_FILE)) as f:
+            index = {key: (offset, length) for key, (offset, length) in json.load(f)["index"].items()}
+        return cls(path, index, memory_map)
+
+    def __getstate__(self) -> dict:
+        return {'path': self._path, 'index': self._index, 'memory_map': self._memory_map}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['path'], state['index'], state['memory_map'])
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def get_keys(self) -> list[str]:
+        return list(self._index)
+
+    def get(self, key: str) -> str | None:
+        """
+        Return the Newick string of the tree a_b_c_d, or None if the archive does not have it.
+        """
+        if key not in self._index:
+            return None
+        offset, length = self._index[key]
+        if self._file is None:
+            self._file = open(os.path.join(self._path, _TREES_FILE), 'rb')
+            if self._memory_map and os.fstat(self._file.fileno()).st_size:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map is not None:
+            return self._map[offset:offset + length].decode()
+        self._file.seek(offset)
+        return self._file.read(length).decode()
+
+    def read_newick_from_file(self, file_name: str) -> str | None:
+        """
+        Same as Utils.read_newick_from_file(base_path, file_name), from the archive.
+        """
+        match = _TREE_FILE_NAME.match(file_name)
+        if not match:
+            print(f"Invalid file name format: {file_name}")
+            return None
+        newick = self.get(match.group(1))
+        if newick is None:
+            print(f"Tree not found in {self._path}: {file_name}")
+        return newick
+
+    def close(self) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,436 @@
+import math
+import numpy as np
+import networkx as nx
+from itertools import combinations
+from src.Utils.CompactTree import CompactTree, EVENT_GENE, EVENT_SPECIATION
+from src.neighbor_joining.NanNeighborJoining import NJTree
+
+_BLOCK_ELEMENTS = 1 << 18  # Edge pairs scored per block (bounds the temporary arrays)
+_LABEL_BITS = 21           # Bits per label ID in a packed triplet key
+
+
+def _as_compact(tree: nx.DiGraph | CompactTree) -> CompactTree:
+    return tree if isinstance(tree, CompactTree) else CompactTree.from_graph(tree)
+
+
+def _gene_labels(tree: CompactTree) -> tuple[np.ndarray, list]:
+    """
+    Return the preorder positions of the gene leaves (loss leaves excluded) and their labels.
+    """
+    leaves = np.flatnonzero(tree.get_events() == EVENT_GENE)
+    return leaves, [tree.get_label(leaf) for leaf in leaves.tolist()]
+
+
+def _triplet_edges(tree: CompactTree, is_counted: np.ndarray) -> np.ndarray:
+    """
+    Return the edges x -> p that root triplets (p is a speciation) as the ranges of the counted leaves below x and
+    below p, one column per edge: rank[x], rank[end(x)], rank[p], rank[end(p)].
+
+    A node v has the counted leaves with ranks in [rank[v], rank[end(v)]), where rank[q] is the number of counted
+    leaves before the preorder position q.
+    """
+    parent, ends = tree.get_parent(), tree.get_subtree_ends()
+    rank = np.concatenate(([0], np.cumsum(is_counted, dtype=np.int64)))
+    x = np.flatnonzero(parent >= 0)
+    x = x[tree.get_events()[parent[x]] == EVENT_SPECIATION]
+    p = parent[x]
+    return np.stack((rank[x], rank[ends[x]], rank[p], rank[ends[p]]))
+
+
+def count_triplets(tree: nx.DiGraph | CompactTree) -> int:
+    """
+    Return len(set(Utils.get_triplets(tree, color='label'))) for a tree whose gene leaf labels are unique, without
+    listing the triplets: an edge x -> p with p a speciation roots C(|L(x)|, 2) * (|L(p)| - |L(x)|) of them.
+    """
+    tree = _as_compact(tree)
+    ranges = _triplet_edges(tree, tree.get_events() == EVENT_GENE)
+    in_x = ranges[1] - ranges[0]
+    return int(np.sum(in_x * (in_x - 1) // 2 * (ranges[3] - ranges[2] - in_x)))
+
+
+def packed_triplets(tree: nx.DiGraph | CompactTree, label_index: dict) -> np.ndarray:
+    """
+    Return the triplets of Utils.get_triplets(tree, color='label') as sorted unique int64 keys.
+
+    The triplet bc|a is packed as (b << 42) | (c << 21) | a, with b < c, where b, c and a are the label_index IDs of
+    the labels; labels not in label_index yet are added to it. Keys are made in one vectorized block per pair of
+    children of each speciation node.
+
+    :param label_index: ID of every label seen so far, shared by all the trees to compare.
+    """
+    tree = _as_compact(tree)
+    events = tree.get_events()
+    I: dict[int, np.ndarray] = {}  # Sorted label IDs below each node
+    blocks = []
+    for v in range(len(tree) - 1, -1, -1):  # Reverse preorder: children before parents
+        children = tree.get_children(v).tolist()
+        if not children:
+            labels = [label_index.setdefault(tree.get_label(v), len(label_index))] if events[v] == EVENT_GENE else []
+            I[v] = np.array(labels, dtype=np.int64)
+            continue
+        if v != 0:
+            I[v] = np.unique(np.concatenate([I[child] for child in children]))
+        if events[v] == EVENT_SPECIATION:
+            for x0, x1 in combinations(children, 2):
+                for x_out, x_in in ((x0, x1), (x1, x0)):
+                    b, c = np.triu_indices(len(I[x_in]), 1)
+                    b, c = I[x_in][b], I[x_in][c]
+                    a = I[x_out][:, None]
+                    keys = (b << (2 * _LABEL_BITS)) | (c << _LABEL_BITS) | a
+                    blocks.append(keys[(a != b) & (a != c)])
+    if len(label_index) > 1 << _LABEL_BITS:
+        raise ValueError(f"At most {1 << _LABEL_BITS} distinct labels can be packed into triplet keys")
+    return np.unique(np.concatenate(blocks)) if blocks else np.empty(0, dtype=np.int64)
+
+
+def unordered_triplet_keys(keys: np.ndarray) -> np.ndarray:
+    """
+    Return the order-insensitive key of each packed triplet: its three label IDs sorted and packed the same way.
+    """
+    mask = (1 << _LABEL_BITS) - 1
+    labels = np.sort(np.stack((keys >> (2 * _LABEL_BITS), (keys >> _LABEL_BITS) & mask, keys & mask)), axis=0)
+    return (labels[0] << (2 * _LABEL_BITS)) | (labels[1] << _LABEL_BITS) | labels[2]
+
+
+def enumerated_triplet_performance(
+        tree: nx.DiGraph | CompactTree, real_tree: nx.DiGraph | CompactTree
+) -> tuple[int, int, int, int]:
+    """
+    Return the counts (TP, FP, FN, contradictory) of the triplet sets of both trees, listing the triplets as packed
+    keys (see packed_triplets). Works with repeated labels, unlike the counting of TripletReference.
+    """
+    label_index = {}
+    real_triplets = packed_triplets(real_tree, label_index)
+    return _compare_packed(packed_triplets(tree, label_index), real_triplets, unordered_triplet_keys(real_triplets))
+
+
+def _compare_packed(
+        tree1_triples: np.ndarray, tree2_triples: np.ndarray, tree2_sets: np.ndarray
+) -> tuple[int, int, int, int]:
+    tp = len(np.intersect1d(tree1_triples, tree2_triples, assume_unique=True))
+    FP = np.setdiff1d(tree1_triples, tree2_triples, assume_unique=True)
+    contradictory = int(np.count_nonzero(np.isin(unordered_triplet_keys(FP), tree2_sets)))
+    return tp, len(tree1_triples) - tp, len(tree2_triples) - tp, contradictory
+
+
+def _precision_recall_contradiction(tp: int, fp: int, fn: int, contradictory: int) -> tuple[float, float, float]:
+    # Safe division, as get_precision_recall_contradiction: NaN where undefined
+    precision: float = tp / (tp + fp) if (tp + fp) > 0 else math.nan
+    recall: float = tp / (tp + fn) if (tp + fn) > 0 else math.nan
+    contradiction: float = contradictory / (tp + fn) if (tp + fn) > 0 else math.nan
+    return precision, recall, contradiction
+
+
+class TripletReference:
+    """
+    Triplet index of a reference (real) tree, built once to score any number of candidate trees against it.
+
+    With unique gene labels every triplet bc|a of a tree comes from one edge pair: b, c below a child x of a
+    speciation p, and a below p but not below x. For an edge x -> p of a candidate and an edge y -> q of the
+    reference, with M(u, v) the number of leaves shared by the subtrees of u and v:
+        shared triplets          C(M(x, y), 2) * (M(p, q) - M(x, q) - M(p, y) + M(x, y))
+        contradictory triplets   M(x, y) * (M(x, q) - M(x, y)) * (M(p, y) - M(x, y))
+    (a contradiction ab|c against ac|b has a in both pairs, b = the outgroup in the reference, c the one in the
+    candidate). M is read from a 2-D prefix sum over the shared leaves in preorder of both trees, so a comparison
+    takes O(n^2) time and memory instead of the O(n^3) of the triplet sets. The reference keeps its leaf ranks, its
+    edges and its triplet count; if a gene label repeats, its packed triplets instead.
+
+    Scores are cached by tree structure, so a candidate identical to one already scored (e.g. an input tree where
+    no polytomy was resolved) costs only its conversion.
+    """
+
+    def __init__(self, real_tree: nx.DiGraph | CompactTree):
+        self._tree = _as_compact(real_tree)
+        _, labels = _gene_labels(self._tree)
+        self._index = {label: k for k, label in enumerate(labels)}  # Label -> rank among the gene leaves
+        self._scores: dict[tuple, tuple[int, int, int, int]] = {}
+
+        # Packed triplets, built by the first comparison with repeated labels
+        self._packed: tuple[dict, np.ndarray, np.ndarray] | None = None
+        self._repeated_labels = len(self._index) < len(labels)
+        if not self._repeated_labels:
+            self._triplet_count = count_triplets(self._tree)
+            self._ranges = _triplet_edges(self._tree, self._tree.get_events() == EVENT_GENE)
+
+    def get_tree(self) -> CompactTree:
+        return self._tree
+
+    def triplet_performance(self, tree: nx.DiGraph | CompactTree) -> tuple[int, int, int, int]:
+        """
+        Return the counts (TP, FP, FN, contradictory) of Utils.triple_performance(tree, reference tree).
+        """
+        tree = _as_compact(tree)
+        leaves, labels = _gene_labels(tree)
+        signature = (tree.get_parent().tobytes(), tree.get_events().tobytes(), tuple(labels))
+        if signature not in self._scores:
+            self._scores[signature] = self._score(tree, leaves, labels)
+        return self._scores[signature]
+
+    def precision_recall_contradiction(self, tree: nx.DiGraph | CompactTree) -> tuple[float, float, float]:
+        """
+        Return the precision, recall and contradiction of tree against the reference tree; NaN where undefined.
+        """
+        return _precision_recall_contradiction(*self.triplet_performance(tree))
+
+    def resolved_triplet_performance(
+            self, tree: nx.DiGraph | CompactTree, resolutions: dict[int, NJTree], event: str | None = 'S'
+    ) -> tuple[int, int, int, int]:
+        """
+        Return the counts of triplet_performance(tree.splice(resolutions, event)), i.e. of tree with its polytomies
+        resolved, from the counts of tree itself: a resolution only changes the edges below the polytomy node, so
+        only the triplets rooted at the polytomy and at the inserted nodes are recounted. Each of these edges is
+        scored against the reference edges by binary search, so the cost grows with the resolved polytomies and not
+        with the tree.
+
+        Falls back to scoring the spliced tree when a gene label repeats, or when a resolution does not keep the
+        leaves of its polytomy (the splice drops the disconnected clades after the second one).
+
+        :param tree: Tree before the resolutions, with the node numbers they refer to.
+        :param resolutions: NJTree of each resolved polytomy node, as for CompactTree.splice.
+        :param event: Event of the inserted nodes; 'S' by default, as custom_tree marks every node.
+        """
+        tree = _as_compact(tree)
+        tp, fp, fn, contradictory = self.triplet_performance(tree)
+        leaves, labels = _gene_labels(tree)
+        if self._repeated_labels or len(set(labels)) < len(labels):
+            return self.triplet_performance(tree.splice(resolutions, event))
+
+        # Reference rank of every shared leaf of tree (-1 elsewhere) and number of gene leaves before each node
+        ends, events = tree.get_subtree_ends(), tree.get_events()
+        rank_of = np.full(len(tree), -1, dtype=np.int64)
+        rank_of[leaves] = [self._index.get(label, -1) for label in labels]
+        genes_before = np.concatenate(([0], np.cumsum(events == EVENT_GENE)))
+
+        def leaf_set(v: int) -> tuple[np.ndarray, int]:
+            ranks = rank_of[v:ends[v]]
+            return np.sort(ranks[ranks >= 0]), int(genes_before[ends[v]] - genes_before[v])
+
+        inserted_speciation = event == 'S'
+        delta = np.zeros(3, dtype=np.int64)  # TP, contradictory, triplets
+        for node, nj_tree in resolutions.items():
+            taxa, nj_children = nj_tree.get_taxa(), nj_tree.get_children()
+            m = len(taxa)
+            is_speciation = events[node] == EVENT_SPECIATION
+            before = {child: leaf_set(child) for child in tree.get_children(node).tolist()}
+            edges = [(part, leaf_set(node), is_speciation, -1) for part in before.values()]  # (child, parent, ...)
+            used = []
+
+            def joined(parts: list[tuple[np.ndarray, int]], parent_is_speciation: bool) -> tuple[np.ndarray, int]:
+                parent = (np.sort(np.concatenate([part[0] for part in parts] + [np.empty(0, dtype=np.int64)])),
+                          sum(part[1] for part in parts))
+                edges.extend((part, parent, parent_is_speciation, 1) for part in parts)
+                return parent
+
+            def subtree(clade: int | str) -> tuple[np.ndarray, int]:
+                # Leaf set of a clade of the resolution, adding the edges below it (same shape as the splice)
+                if isinstance(clade, str) or clade < m:
+                    used.append(int(clade if isinstance(clade, str) else taxa[clade]))
+                    return before.get(used[-1], (np.empty(0, dtype=np.int64), 0))
+                reachable, stack = [], [clade]
+                while stack:
+                    nj_node = stack.pop()
+                    reachable.append(nj_node)
+                    stack.extend(child for child in nj_children[nj_node - m].tolist() if child >= m)
+                leaf_sets = {}
+                for nj_node in sorted(reachable):  # Children are joined before their parents
+                    leaf_sets[nj_node] = joined([
+                        leaf_sets[child] if child >= m else subtree(child)
+                        for child in nj_children[nj_node - m].tolist()
+                    ], inserted_speciation)
+                return leaf_sets[clade]
+
+            if not taxa:
+                clades = list(nj_tree.get_disconnected_nodes())
+            elif nj_tree.get_disconnected_nodes():
+                clades = [nj_tree.get_root()] + list(nj_tree.get_disconnected_nodes())
+            else:
+                clades = nj_children[-1].tolist()
+            parts = [subtree(clades[0])] if clades else []
+            if len(clades) > 1:
+                second = clades[1]
+                d_children = nj_children[second - m].tolist() if not isinstance(second, str) and second >= m else []
+                parts.append(joined([subtree(child) for child in d_children], inserted_speciation))
+            if sorted(used) != sorted(before):
+                return self.triplet_performance(tree.splice(resolutions, event))
+            joined(parts, is_speciation)
+
+            for child, parent, parent_is_speciation, sign in edges:
+                if parent_is_speciation:
+                    delta += sign * self._edge_terms(child, parent)
+
+        triplets = tp + fp + int(delta[2])
+        tp += int(delta[0])
+        return tp, triplets - tp, self._triplet_count - tp, contradictory + int(delta[1])
+
+    def resolved_precision_recall_contradiction(
+            self, tree: nx.DiGraph | CompactTree, resolutions: dict[int, NJTree], event: str | None = 'S'
+    ) -> tuple[float, float, float]:
+        """
+        Return the precision, recall and contradiction of tree with its polytomies resolved (see
+        resolved_triplet_performance).
+        """
+        return _precision_recall_contradiction(*self.resolved_triplet_performance(tree, resolutions, event))
+
+    def _edge_terms(self, child: tuple[np.ndarray, int], parent: tuple[np.ndarray, int]) -> np.ndarray:
+        """
+        Return the shared triplets, contradictory triplets and triplets rooted at one edge child -> parent of a
+        candidate, given the sorted reference ranks of their shared leaves and their numbers of gene leaves.
+        """
+        (x, x_genes), (p, p_genes) = child, parent
+        start_y, end_y, start_q, end_q = self._ranges
+        xy = np.searchsorted(x, end_y) - np.searchsorted(x, start_y)
+        xq = np.searchsorted(x, end_q) - np.searchsorted(x, start_q)
+        py = np.searchsorted(p, end_y) - np.searchsorted(p, start_y)
+        pq = np.searchsorted(p, end_q) - np.searchsorted(p, start_q)
+        return np.array([
+            np.sum(xy * (xy - 1) // 2 * (pq - xq - py + xy)),
+            np.sum(xy * (xq - xy) * (py - xy)),
+            x_genes * (x_genes - 1) // 2 * (p_genes - x_genes)
+        ], dtype=np.int64)
+
+    def _score(self, tree: CompactTree, leaves: np.ndarray, labels: list) -> tuple[int, int, int, int]:
+        if self._repeated_labels or len(set(labels)) < len(labels):
+            return self._score_packed(tree)
+
+        # Shared leaves: rank among the shared leaves of tree, and among all the gene leaves of the reference
+        shared = [(k, self._index[label]) for k, label in enumerate(labels) if label in self._index]
+        is_shared = np.zeros(len(tree), dtype=bool)
+        prefix = np.zeros((len(shared) + 1, len(self._index) + 1), dtype=np.int32)
+        if shared:
+            shared_1, rank_2 = np.array(shared, dtype=np.int64).T
+            is_shared[leaves[shared_1]] = True
+            rank_1 = np.cumsum(is_shared)[leaves[shared_1]] - 1
+            # prefix[i, j]: shared leaves among the first i of tree and the first j of the reference
+            prefix[rank_1 + 1, rank_2 + 1] = 1
+            np.cumsum(prefix, axis=0, out=prefix)
+            np.cumsum(prefix, axis=1, out=prefix)
+
+        ranges_1 = _triplet_edges(tree, is_shared)
+        ranges_1 = ranges_1[:, ranges_1[1] > ranges_1[0]]  # Edges without shared leaves below x add nothing
+        ranges_2 = self._ranges
+
+        def shared_leaves(rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+            start_1, end_1 = rows[0][:, None], rows[1][:, None]
+            start_2, end_2 = cols[0][None, :], cols[1][None, :]
+            return (prefix[end_1, end_2] - prefix[start_1, end_2] - prefix[end_1, start_2]
+                    + prefix[start_1, start_2]).astype(np.int64)
+
+        tp = contradictory = 0
+        block = max(1, _BLOCK_ELEMENTS // max(1, ranges_2.shape[1]))
+        for start in range(0, ranges_1.shape[1], block):
+            rows = ranges_1[:, start:start + block]
+            xy = shared_leaves(rows[0:2], ranges_2[0:2])
+            xq = shared_leaves(rows[0:2], ranges_2[2:4])
+            py = shared_leaves(rows[2:4], ranges_2[0:2])
+            pq = shared_leaves(rows[2:4], ranges_2[2:4])
+            tp += int(np.sum(xy * (xy - 1) // 2 * (pq - xq - py + xy)))
+            contradictory += int(np.sum(xy * (xq - xy) * (py - xy)))
+
+        return tp, count_triplets(tree) - tp, self._triplet_count - tp, contradictory
+
+    def _score_packed(self, tree: CompactTree) -> tuple[int, int, int, int]:
+        if self._packed is None:
+            label_index = {}
+            triplets = packed_triplets(self._tree, label_index)
+            self._packed = (label_index, triplets, unordered_triplet_keys(triplets))
+        label_index, triplets, triplet_sets = self._packed
+        return _compare_packed(packed_triplets(tree, label_index), triplets, triplet_sets)
+
+
+def triplet_performance(
+        tree: nx.DiGraph | CompactTree, real_tree: nx.DiGraph | CompactTree
+) -> tuple[int, int, int, int]:
+    """
+    Return the counts (TP, FP, FN, contradictory) of Utils.triple_performance without listing any triplet (see
+    TripletReference). To score several trees against the same real tree, build one TripletReference instead.
+
+    :param tree: Tree to evaluate.
+    :param real_tree: Real (ground-truth) tree.
+    """
+    return TripletReference(real_tree).triplet_performance(tree)
+
+
+def test_triplet_performance(trials: int = 300):
+    import src.Utils.Utils as utils
+    rng = np.random.default_rng(0)
+
+    def random_nhx(n: int, labels: list[str]) -> str:
+        clades = list(labels[:n])
+        while len(clades) > 1:
+            k = int(rng.integers(2, min(4, len(clades)) + 1))
+            picked = sorted(rng.choice(len(clades), k, replace=False).tolist(), reverse=True)
+            clades = [c for i, c in enumerate(clades) if i not in picked] + [
+                "(" + ",".join(clades[i] for i in picked) + ")S"
+            ]
+        return clades[0] + ";"
+
+    same = 0
+    for trial in range(trials):
+        n = int(rng.integers(3, 25))
+        pool = [f"G{k}" for k in range(n + 5)] + ["X"] * 3
+        labels_1 = rng.permutation(pool).tolist()
+        labels_2 = rng.permutation(pool).tolist()
+        if trial % 10 == 0:
+            labels_1[1] = labels_1[0]  # Repeated label: enumeration
+        tree = utils.custom_tree(random_nhx(n, labels_1))
+        real_tree = utils.custom_tree(random_nhx(n, labels_2))
+        reference = TripletReference(real_tree)
+        expected = utils.triple_performance(tree, real_tree)  # Set-based: the triplets listed by get_triplets
+        same += reference.triplet_performance(tree) == expected
+        same += enumerated_triplet_performance(tree, real_tree) == expected
+        same += reference.triplet_performance(real_tree) == utils.triple_performance(real_tree, real_tree)
+    print(f"TripletReference.triplet_performance and the packed triplets == triple_performance: "
+          f"{same}/{3 * trials}")
+
+
+def test_resolved_triplet_performance(trials: int = 200):
+    import src.Utils.Utils as utils
+    from src.neighbor_joining.NanNeighborJoining import resolve_polytomy_with_nan
+    rng = np.random.default_rng(1)
+
+    def random_nhx(n: int, labels: list[str]) -> str:
+        clades = list(labels[:n])
+        while len(clades) > 1:
+            k = int(rng.integers(2, min(6, len(clades)) + 1))
+            picked = sorted(rng.choice(len(clades), k, replace=False).tolist(), reverse=True)
+            clades = [c for i, c in enumerate(clades) if i not in picked] + [
+                "(" + ",".join(clades[i] for i in picked) + ")" + ("S" if rng.random() < 0.8 else "D")
+            ]
+        return clades[0] + ";"
+
+    def set_based(tree: CompactTree, resolutions: dict[int, NJTree], real_tree: nx.DiGraph) -> tuple:
+        # Oracle independent of the splice and of the counting: the original graph splice, then the triplet sets
+        graph = tree.to_graph()
+        for x, nj_tree in resolutions.items():
+            graph = utils.update_tree_with_newick(graph, x, nj_tree.to_newick())
+        graph.root = 0
+        for v in graph:
+            graph.nodes[v].setdefault('event', 'S')  # What custom_tree gives the inserted nodes
+        return utils.triple_performance(graph, real_tree)
+
+    same = 0
+    for trial in range(trials):
+        n = int(rng.integers(4, 30))
+        pool = [f"G{k}" for k in range(n + 5)] + ["X"] * 3
+        tree = CompactTree.from_graph(utils.custom_tree(random_nhx(n, rng.permutation(pool).tolist())))
+        real_tree = utils.custom_tree(random_nhx(n, rng.permutation(pool).tolist()))
+        reference = TripletReference(real_tree)
+        resolutions = {}
+        for x in tree.get_polytomies():
+            taxa = [str(y) for y in tree.get_children(x).tolist()]
+            D = rng.random((len(taxa), len(taxa)))
+            D = D + D.T
+            D[rng.random(D.shape) < 0.2] = np.nan  # Missing pairs, some taxa disconnected
+            D = np.fmax(D, D.T)
+            np.fill_diagonal(D, 0)
+            resolutions[x] = resolve_polytomy_with_nan(D, taxa)
+        expected = set_based(tree, resolutions, real_tree)
+        same += reference.resolved_triplet_performance(tree, resolutions) == expected
+        same += reference.triplet_performance(tree.splice(resolutions, 'S')) == expected
+    print(f"TripletReference.resolved_triplet_performance and the splice == triple_performance of the graph "
+          f"splice: {same}/{2 * trials}")
+
+
+if __name__ == "__main__":
+    test_triplet_performance()
+    test_resolved_triplet_performance()
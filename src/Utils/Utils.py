@@ -1,19 +1,24 @@
 import os
 import re
-import math
+import hashlib
 import pandas
 import numpy as np
 from math import log
 import networkx as nx
-from Bio import Phylo
-from io import StringIO
+from typing import Iterator
 from pandas import read_csv
 import src.neighbor_joining.DMSeries as dms
-from revolutionhtl.nhxx_tools import read_nhxx
+import src.Utils.Instrumentation as instrumentation
+from src.Utils.TreeArchive import TreeArchive
+from src.Utils.DistanceStore import DistanceStore
+from src.Utils.Triplets import TripletReference
+from src.Utils.CompactTree import CompactTree
+from src.Utils.Newick import parse_nhx, read_nhx
 from revolutionhtl.nxTree import induced_colors
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain, product, combinations
 from src.polytomy_identification.TreePolytomies import TreePolytomies
-from revolutionhtl.parse_prt import load_all_hits_raw, normalize_scores
+from revolutionhtl.parse_prt import load_all_hits_raw, normalize_scores, identify_file_pairs
 
 
 def is_polytomi(T, node):
@@ -24,27 +29,128 @@ def get_polytomies(T):
     return [node for node in T if is_polytomi(T, node)]
 
 
+def get_tree_polytomies(og: int, tree: nx.DiGraph) -> TreePolytomies | None:
+    nodes_with_polytomies = get_polytomies(tree)
+
+    if not nodes_with_polytomies:
+        return None
+
+    X: dict[
+        int, dict[
+            int, list[int | str]
+        ]
+    ] = {x: {} for x in nodes_with_polytomies}
+
+    for x in nodes_with_polytomies:
+        Y = list(tree.successors(x))
+        for y_i in Y:
+            X[x][y_i] = list(induced_colors(tree, y_i, 'label'))
+
+    return TreePolytomies(og, tree, X)
+
+
 def get_trees_with_polytomies(gene_trees: nx.DiGraph) -> list[TreePolytomies]:
     trees_with_polytomies: list[TreePolytomies] = []
 
     for og, tree in enumerate(gene_trees):
-        nodes_with_polytomies = get_polytomies(tree)
+        tp = get_tree_polytomies(og, tree)
+        if tp is not None:
+            trees_with_polytomies.append(tp)
 
-        if nodes_with_polytomies:
-            X: dict[
-                int, dict[
-                    int, list[int | str]
-                ]
-            ] = {x: {} for x in nodes_with_polytomies}
+    return trees_with_polytomies
 
-            for x in nodes_with_polytomies:
-                Y = list(tree.successors(x))
-                for y_i in Y:
-                    X[x][y_i] = list(induced_colors(tree, y_i, 'label'))
 
-            trees_with_polytomies.append(TreePolytomies(og, tree, X))
+_NHX_BRACKETS = re.compile(r'\[[^\]]*\]')          # NHX attributes, dropped before scanning the structure
+_NEWICK_LEAF = re.compile(r'[(,]([^(),:;]+)')      # Text right after '(' or ',' (i.e. a leaf) up to its end
 
-    return trees_with_polytomies
+
+def newick_has_polytomy(nhx: str) -> bool:
+    """
+    String-level version of bool(get_polytomies(read_nhxx(nhx))): whether some node of the Newick string has more
+    than two children, found by counting the commas at each parenthesis depth.
+    """
+    commas = [0]
+    for symbol in re.findall(r'[(),]', _NHX_BRACKETS.sub('', nhx)):
+        if symbol == '(':
+            commas.append(0)
+        elif symbol == ',':
+            commas[-1] += 1
+        elif commas.pop() > 1:
+            return True
+    return False
+
+
+def newick_polytomy_degrees(nhx: str) -> list[int]:
+    """
+    Return the number of children of every node of a Newick string that has more than two, in closing order; the
+    same comma count as newick_has_polytomy, over the whole string.
+    """
+    commas = [0]
+    degrees = []
+    for symbol in re.findall(r'[(),]', _NHX_BRACKETS.sub('', nhx)):
+        if symbol == '(':
+            commas.append(0)
+        elif symbol == ',':
+            commas[-1] += 1
+        else:
+            children = commas.pop() + 1
+            if children > 2:
+                degrees.append(children)
+    return degrees
+
+
+def newick_leaf_labels(nhx: str) -> list[str]:
+    """
+    Return the leaf labels of a Newick string, as read_nhxx would set their 'label', without building the tree.
+    """
+    return [label.strip() for label in _NEWICK_LEAF.findall(_NHX_BRACKETS.sub('', nhx))]
+
+
+def newick_leaf_prefix(nhx: str) -> str | None:
+    """
+    Return the prefix (text before '|') shared by all the leaves of a Newick string, or None if they differ; the
+    string-level version of the prefix main.extract_leaves_with_prefix finds.
+    """
+    prefixes = {label.split('|')[0] for label in newick_leaf_labels(nhx)}
+    return prefixes.pop() if len(prefixes) == 1 else None
+
+
+def iter_newick_trees(trees_path: str, chunksize: int = 1024) -> Iterator[tuple[int, str]]:
+    """
+    Yield (OG, NHX string) for every row of a reconciliation TSV file, the OG being the row number, reading only the
+    'tree' column, chunksize rows at a time.
+    """
+    with read_csv(trees_path, sep='\t', usecols=['tree'], chunksize=chunksize) as reader:
+        yield from enumerate(chain.from_iterable(chunk.tree.tolist() for chunk in reader))
+
+
+def iter_trees_with_polytomies(
+        trees_path: str, ogs: set[int] | None = None, same_leaf_prefix: bool = False, chunksize: int = 1024
+) -> Iterator[TreePolytomies]:
+    """
+    Lazy version of get_trees_with_polytomies(read_csv(trees_path, sep='\t').tree.apply(read_nhxx)): yield the trees
+    with polytomies one at a time, in file order, with the same OG numbers (their row in the file).
+
+    The file is read in chunks of rows with only the 'tree' column, and every tree goes through cheap string-level
+    filters first -- OG selection, leaf prefix, presence of a polytomy -- so only the trees that pass them are parsed.
+
+    :param trees_path: Reconciliation TSV file.
+    :param ogs: OGs to keep, or None for all of them.
+    :param same_leaf_prefix: Only keep the trees whose leaves all share one prefix (see newick_leaf_prefix).
+    :param chunksize: Rows read at a time.
+    """
+    for og, nhx in iter_newick_trees(trees_path, chunksize):
+        if ogs is not None and og not in ogs:
+            continue
+        if same_leaf_prefix and newick_leaf_prefix(nhx) is None:
+            continue
+        if not newick_has_polytomy(nhx):
+            continue
+        instrumentation.count('parsed_trees', og=instrumentation.RUN)
+        with instrumentation.stage('parse_tree', og=og):
+            tp = get_tree_polytomies(og, read_nhx(nhx))
+        if tp is not None:
+            yield tp
 
 
 def load_hits_compute_distance_pairs(hits_path: str) -> pandas.Series:
@@ -63,15 +169,171 @@ def load_hits_compute_distance_pairs(hits_path: str) -> pandas.Series:
     return distance
 
 
-def get_pair_distance(distance_pairs_series: pandas.Series, leaf_1: str, leaf_2: str) -> float:
+# Only the columns the 'target' normalization needs, out of the DIAMOND hits columns
+_HITS_COLUMNS = ['Query_accession', 'Target_accession', 'Query_length', 'Target_length',
+                 'Alignment_length', 'Bit_score', 'Evalue']
+_HITS_USECOLS = ['Query_accession', 'Target_accession', 'Target_length', 'Bit_score']
+_HITS_DTYPES = {'Query_accession': str, 'Target_accession': str, 'Target_length': np.int32, 'Bit_score': np.float64}
+
+
+def _read_hits_file(file_path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Read one DIAMOND hits file and return its directed hits as (queries, targets, Bit_score / Target_length).
+    Accessions are kept as read, as revolutionhtl's parse_prt_hits does, and, as in its score dictionary, the last
+    hit of a repeated (query, target) pair wins.
+    """
+    df = read_csv(file_path, sep='\t', names=_HITS_COLUMNS, usecols=_HITS_USECOLS, dtype=_HITS_DTYPES)
+    df = df.drop_duplicates(['Query_accession', 'Target_accession'], keep='last')
+
+    return (df.Query_accession.to_numpy(dtype=object), df.Target_accession.to_numpy(dtype=object),
+            (df.Bit_score / df.Target_length).to_numpy(dtype=np.float64))
+
+
+def compute_distance_store(hits_path: str, workers: int | None = None) -> DistanceStore:
+    """
+    Parallel, column-pruned equivalent of load_hits_compute_distance_pairs that returns a DistanceStore.
+
+    The hits files are parsed concurrently in a process pool (reading only the accessions, Target_length and
+    Bit_score), then the directed normalized scores are symmetrized (average of both directions) and turned into
+    scoredist distances, giving the same values as the pandas/revolutionhtl path.
+
+    :param hits_path: Path to the hits directory.
+    :param workers: Number of worker processes; None uses every CPU and 1 parses in the calling process.
+    :return: A DistanceStore.
+    """
+    species_pairs = identify_file_pairs(hits_path)  # Same file order (and missing-file checks) as load_all_hits_raw
+    file_paths = [os.path.join(hits_path, file) for files in species_pairs.values() for file in files]
+
+    workers = workers or os.cpu_count() or 1
+    with instrumentation.stage('parse_hits'):
+        if workers == 1 or len(file_paths) <= 1:
+            parsed = list(map(_read_hits_file, file_paths))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = list(executor.map(_read_hits_file, file_paths, chunksize=max(1, len(file_paths) // 256)))
+    instrumentation.count('hits_files', len(file_paths))
+
+    if not parsed:
+        return DistanceStore.from_pairs([], [], [])
+    queries = np.concatenate([q for q, _, _ in parsed])
+    targets = np.concatenate([t for _, t, _ in parsed])
+    scores = np.concatenate([s for _, _, s in parsed])
+
+    # Last directed hit wins across files too, then average the two directions of every undirected pair
+    codes, ids = pandas.factorize(np.concatenate((queries, targets)))
+    q, t = codes[:len(queries)], codes[len(queries):]
+    _, last = np.unique((q * len(ids) + t)[::-1], return_index=True)
+    last = len(q) - 1 - last
+    lo, hi = np.minimum(q[last], t[last]), np.maximum(q[last], t[last])
+    pairs, inverse = np.unique(lo * len(ids) + hi, return_inverse=True)
+    normalized = np.bincount(inverse, weights=scores[last]) / np.bincount(inverse)
+
+    # log correction of normalized bitscore a.k.a scoredist (math.log, to match the values of the pandas path)
+    halves = np.minimum(normalized / 2, 1)
+    distance = -np.fromiter((log(x) for x in halves), dtype=np.float64, count=len(halves)) * 100
+    instrumentation.count('hits', len(queries))
+    instrumentation.count('distance_pairs', len(distance))
+
+    return DistanceStore.from_pairs(ids[pairs // len(ids)], ids[pairs % len(ids)], distance)
+
+
+# Identifies how load_hits_compute_distance_pairs turns hits into distances; part of the cache key.
+DISTANCE_METHOD = "scoredist: -log(min(x / 2, 1)) * 100, x = bit score normalized by target length; raw accessions"
+
+
+def _file_sha1(file_path: str, chunk_size: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def hits_fingerprint(hits_path: str, previous: dict | None = None) -> dict:
+    """
+    Fingerprint the alignment hits files of a directory by name, size, mtime and SHA-1.
+
+    :param hits_path: Path to the hits directory.
+    :param previous: A fingerprint computed earlier; files whose size and mtime did not change reuse its hash
+                     instead of being read again.
+    :return: {'distance': DISTANCE_METHOD, 'files': {name: {'size': ..., 'mtime_ns': ..., 'sha1': ...}}}
+    """
+    previous_files = (previous or {}).get('files', {})
+    files = {}
+    for name in sorted(os.listdir(hits_path)):
+        if not name.endswith('.alignment_hits'):
+            continue
+        stat = os.stat(os.path.join(hits_path, name))
+        old = previous_files.get(name, {})
+        if old.get('size') == stat.st_size and old.get('mtime_ns') == stat.st_mtime_ns:
+            sha1 = old['sha1']
+        else:
+            sha1 = _file_sha1(os.path.join(hits_path, name))
+        files[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+
+    return {'distance': DISTANCE_METHOD, 'files': files}
+
+
+def _same_hits(fingerprint_1: dict, fingerprint_2: dict) -> bool:
+    def content(fingerprint):
+        files = fingerprint.get('files', {})
+        return fingerprint.get('distance'), {name: (f['size'], f['sha1']) for name, f in files.items()}
+
+    return content(fingerprint_1) == content(fingerprint_2)
+
+
+def distance_cache_is_current(hits_path: str, cache_path: str) -> bool:
+    """
+    Return whether cache_path holds the distance cache of the hits files as they are now, down to their mtimes, so
+    that load_hits_distance_store would only read it.
+    """
+    cached = DistanceStore.read_metadata(cache_path)
+    return cached is not None and cached == hits_fingerprint(hits_path, previous=cached)
+
+
+def load_hits_distance_store(
+        hits_path: str, cache_path: str | None = None, workers: int | None = None
+) -> DistanceStore:
+    """
+    Load alignment hits and compute pairwise distances into an integer-indexed DistanceStore.
+
+    If cache_path is given, the final distances and the ID table are kept there on disk and memory-mapped on later
+    calls. The cache is keyed by the hits files' sizes, mtimes and hashes, and rebuilt when any of them changes.
+
+    :param hits_path: Path to the hits file.
+    :param cache_path: Directory of the on-disk cache, or None to always recompute.
+    :param workers: Number of processes used to parse the hits files (see compute_distance_store).
+    :return: A DistanceStore with the same pairs and distances as load_hits_compute_distance_pairs.
+    """
+    if cache_path is None:
+        return compute_distance_store(hits_path, workers)
+
+    cached = DistanceStore.read_metadata(cache_path)
+    fingerprint = hits_fingerprint(hits_path, previous=cached)
+
+    if cached is not None and _same_hits(cached, fingerprint):
+        if cached != fingerprint:  # Same content, touched files: remember the new mtimes
+            DistanceStore.write_metadata(cache_path, fingerprint)
+        instrumentation.count('distance_cache_hits')
+        return DistanceStore.load(cache_path)
+
+    store = compute_distance_store(hits_path, workers)
+    store.save(cache_path, metadata=fingerprint)
+    return DistanceStore.load(cache_path)
+
+
+def get_pair_distance(distance_pairs_series: pandas.Series | DistanceStore, leaf_1: str, leaf_2: str) -> float:
     """
     Retrieve the pairwise distance for two leaves from a pandas Series indexed by frozensets.
 
-    :param distance_pairs_series: pandas Series where the index is frozensets of leaf pairs.
+    :param distance_pairs_series: pandas Series where the index is frozensets of leaf pairs, or a DistanceStore.
     :param leaf_1: The first leaf identifier.
     :param leaf_2: The second leaf identifier.
     :return: The distance between the pair of leaves if present, else np.nan.
     """
+    if isinstance(distance_pairs_series, DistanceStore):
+        return distance_pairs_series.distance(leaf_1, leaf_2)
+
     pair = frozenset({leaf_1, leaf_2})
     return distance_pairs_series.get(pair, np.nan)
 
@@ -126,9 +388,14 @@ def update_tree_with_newick(D, node, newick_str) -> nx.DiGraph:
     # Create a copy of the original graph
     new_graph = D.copy()
 
-    # Parse the Newick string into a tree
-    handle = StringIO(newick_str)
-    tree = Phylo.read(handle, "newick")
+    # Parse the Newick string into a tree: clade v has the children clades[v] and the name names[v]; the root clade
+    # is 1, the first node under the dummy root of parse_nhx
+    parents, attributes = parse_nhx(newick_str, name_attr='name')
+    clades: list[list[int]] = [[] for _ in parents]
+    for clade, parent in enumerate(parents):
+        if parent >= 0:
+            clades[parent].append(clade)
+    names = [clade_attributes['name'] for clade_attributes in attributes]
 
     # Generate new nodes for internal nodes introduced in the Newick tree
     new_node_id = max(new_graph.nodes) + 1  # Start creating new nodes from max existing ID + 1
@@ -136,9 +403,9 @@ def update_tree_with_newick(D, node, newick_str) -> nx.DiGraph:
 
     def map_newick_clade(clade):
         nonlocal new_node_id
-        if clade.is_terminal():
+        if not clades[clade]:
             # Terminal nodes are the same as the original nodes
-            return int(clade.name)
+            return int(names[clade])
         else:
             # Create a new internal node
             new_internal_node = new_node_id
@@ -148,13 +415,13 @@ def update_tree_with_newick(D, node, newick_str) -> nx.DiGraph:
 
     # Traverse the Newick tree to add the resolved structure
     def add_newick_edges(clade, parent):
-        if clade.is_terminal():
+        if not clades[clade]:
             # Terminal node: add edge to the terminal node
-            return int(clade.name)
+            return int(names[clade])
         else:
             # Internal node: add edge to a new internal node
             internal_node = map_newick_clade(clade)
-            for child in clade.clades:
+            for child in clades[clade]:
                 child_node = add_newick_edges(child, internal_node)
                 new_graph.add_edge(internal_node, child_node)
             return internal_node
@@ -164,15 +431,14 @@ def update_tree_with_newick(D, node, newick_str) -> nx.DiGraph:
         new_graph.remove_edge(node, child)
 
     # Add the resolved structure to the graph
-    root_clade = tree.clade
-    clades = root_clade.clades
+    root_clades = clades[1]
 
-    if len(clades) >= 1:
+    if len(root_clades) >= 1:
         # First child of the Newick tree becomes a direct child of `node`
-        first_child = add_newick_edges(clades[0], node)
+        first_child = add_newick_edges(root_clades[0], node)
         new_graph.add_edge(node, first_child)
 
-    if len(clades) > 1:
+    if len(root_clades) > 1:
         # Second clade introduces a new internal node
         new_internal_node = new_node_id
         new_node_id += 1
@@ -183,7 +449,7 @@ def update_tree_with_newick(D, node, newick_str) -> nx.DiGraph:
         new_graph.nodes[new_internal_node]['species'] = None
 
         # Add the subtrees rooted at the second clade
-        for child_clade in clades[1].clades:
+        for child_clade in clades[root_clades[1]]:
             child_node = add_newick_edges(child_clade, new_internal_node)
             new_graph.add_edge(new_internal_node, child_node)
 
@@ -243,7 +509,7 @@ def transform_newick(input_newick):
 
 
 def print_all_trees_with_polytomies(
-        trees_with_polytomies:list[TreePolytomies], distance_pairs: pandas.Series, verbose=True
+        trees_with_polytomies:list[TreePolytomies], distance_pairs: pandas.Series | DistanceStore, verbose=True
 ) -> None:
     for idx, tp in enumerate(trees_with_polytomies):
         print(f"{idx = }")
@@ -253,7 +519,7 @@ def print_all_trees_with_polytomies(
             for x in X:
                 Y: list[int] = tp.get_ys(x)
                 C: list[list[str]] = [tp.get_cluster(x, y_i) for y_i in Y]
-                D, _, info = dms.compute_distance_matrix(distance_pairs, C, Y)
+                D, _, info = dms.compute_distance_matrix(distance_pairs, C, Y, diagnostics=dms.DIAGNOSTICS_FULL)
                 print(info)
 
         print(f"{'-'*80}\n")
@@ -286,12 +552,16 @@ def read_newick_from_file(base_path, file_name):
     from the file name (ga_b_c_d.pruned.tree format).
 
     Args:
-        base_path (str): Path to the root folder (e.g., 'input/true_gene_trees/').
+        base_path (str | TreeArchive): Path to the root folder (e.g., 'input/true_gene_trees/'), or an archive
+            packed from it (one seek per tree instead of one file).
         file_name (str): Name of the file in the format 'ga_b_c_d.pruned.tree'.
 
     Returns:
         str: The Newick string from the file, or None if the file is not found or invalid.
     """
+    if isinstance(base_path, TreeArchive):
+        return base_path.read_newick_from_file(file_name)
+
     # Validate and parse the file name using regex
     pattern = re.compile(r"^g(\d+)_(\d+)_(\d+)_(\d+)\.pruned\.tree$")
     match = pattern.match(file_name)
@@ -325,7 +595,7 @@ def read_newick_from_file(base_path, file_name):
 # Convert to nxTree
 # -----------------
 def custom_tree(nhx):
-    T= read_nhxx(nhx)
+    T= read_nhx(nhx)
     for x in T:
         T.nodes[x]['event']= 'S'
         if T.out_degree(x) == 0:  # TODO: ask Toño if it is valid; CHANGES a leaf from 'noD_5_10_4_2|G17_7' to 'G17_7'
@@ -333,6 +603,28 @@ def custom_tree(nhx):
     return T
 
 
+def custom_attributes(attributes: dict, is_leaf: bool) -> dict:
+    """
+    The change custom_tree makes to the attributes of one node, as a CompactTree transform: every node is an 'S'
+    event and a leaf keeps only the part of its label after the last '|'.
+    """
+    attributes = {**attributes, 'event': 'S'}
+    if is_leaf:
+        attributes['label'] = attributes['label'].split('|')[-1]
+    return attributes
+
+
+def custom_compact_tree(tree: nx.DiGraph | str) -> CompactTree:
+    """
+    CompactTree.from_graph(custom_tree(...)) without the text round-trip: an in-memory gene tree is converted
+    directly (its nodes numbered 0..n-1 in preorder from its root, no dummy root above it) and an NHX string is
+    parsed once, straight into the arrays.
+    """
+    if isinstance(tree, str):
+        return CompactTree.from_nhx(tree, transform=custom_attributes)
+    return CompactTree.from_graph(tree, transform=custom_attributes)
+
+
 ######################
 # Compue performance #
 ######################
@@ -396,14 +688,9 @@ def get_precision_recall_contradiction(tree: nx.DiGraph, real_tree: nx.DiGraph)
         tuple[float, float, float]: Precision, recall, and contradiction values.
                                       NaN is returned for undefined values (e.g., division by zero).
     """
-    tp, fp, fn, contradictory = triple_performance(tree, real_tree)
-
-    # Compute precision, recall, and contradiction with safe division
-    precision: float = tp / (tp + fp) if (tp + fp) > 0 else math.nan
-    recall: float = tp / (tp + fn) if (tp + fn) > 0 else math.nan
-    contradiction: float = contradictory / (tp + fn) if (tp + fn) > 0 else math.nan
-
-    return precision, recall, contradiction
+    # Same counts as triple_performance, without listing the triplets. To score several trees against the same
+    # real tree, use one TripletReference for all of them
+    return TripletReference(real_tree).precision_recall_contradiction(tree)
 
 
 def is_diagonal_zero_and_nan_elsewhere(D: np.ndarray) -> bool:
@@ -430,12 +717,12 @@ def is_diagonal_zero_and_nan_elsewhere(D: np.ndarray) -> bool:
 
 
 def load_distance_pairs_and_trees_with_polytomies(
-        hits_path: str, trees_path: str
-) -> tuple[pandas.Series, list[TreePolytomies]]:
+        hits_path: str, trees_path: str, distance_cache_path: str | None = None, hits_workers: int | None = None
+) -> tuple[DistanceStore, list[TreePolytomies]]:
     # Load the hits and gtrees data from input files
-    distance_pairs = load_hits_compute_distance_pairs(hits_path)  # Load distances
+    distance_pairs = load_hits_distance_store(hits_path, distance_cache_path, hits_workers)  # Load distances
     gTrees = read_csv(trees_path, sep='\t')                             # Load trees
-    gTrees = gTrees.set_index('OG').tree.apply(read_nhxx)               # Load trees
+    gTrees = gTrees.set_index('OG').tree.apply(read_nhx)                 # Load trees
     trees_with_polytomies = get_trees_with_polytomies(gTrees)     # Identify those trees with polytomies
 
     return distance_pairs, trees_with_polytomies
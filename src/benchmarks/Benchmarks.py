@@ -0,0 +1,250 @@
+import os
+import io
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import src.Utils.Utils as utils
+import src.neighbor_joining.DMSeries as dms
+import src.neighbor_joining.NanNeighborJoining as nnj
+from math import log
+from main import computations
+from datetime import datetime
+from itertools import product
+from contextlib import redirect_stdout
+from src.Utils.Newick import write_nhx
+from src.Utils.DistanceStore import DistanceStore
+from src.benchmarks.SyntheticData import write_dataset
+from src.polytomy_identification.TreePolytomies import TreePolytomies
+
+# Parameter sweeps: every combination of the values of a benchmark is one case. 'size' of a case is the number of
+# genes under its polytomies (compute_distance_matrix), of taxa (neighbor_joining), of tree nodes
+# (update_tree_with_newick), of leaves (get_precision_recall_contradiction) or of OGs (computations).
+SWEEPS = {
+    'compute_distance_matrix': {'degree': [4, 16, 64], 'cluster_size': [1, 8, 32], 'missing': [0.0, 0.5]},
+    'neighbor_joining': {
+        'taxa': [16, 64, 256, 512], 'missing': [0.0, 0.5],
+        'engine': [nnj.NJ_ENGINE_CANONICAL, nnj.NJ_ENGINE_IN_PLACE, nnj.NJ_ENGINE_RAPID],
+    },
+    'update_tree_with_newick': {'degree': [4, 16, 64, 256], 'cluster_size': [1, 4]},
+    'get_precision_recall_contradiction': {'polytomies': [1, 4, 16], 'degree': [4, 16], 'cluster_size': [4]},
+    'computations': {'ogs': [16, 64, 256], 'workers': [1, None]},
+}
+
+# Shape of the OGs of the computations benchmark (main.computations on a whole synthetic project)
+COMPUTATIONS_OG = {'polytomies': 2, 'degree': 8, 'cluster_size': 4, 'missing': 0.2}
+
+
+def time_call(fn, repeats: int) -> list[float]:
+    """
+    Wall-clock seconds of repeats calls of fn().
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _synthetic_og(
+        directory: str, seed: int, polytomies: int, degree: int, cluster_size: int, missing: float
+) -> tuple[TreePolytomies, str, DistanceStore]:
+    """
+    Write a one-OG synthetic project to directory and read it back the way main.computations does: the tree with
+    its polytomies, its real tree and the distances between its genes.
+    """
+    paths = write_dataset(directory, 1, polytomies, degree, cluster_size, missing, seed=seed)
+    tp = next(utils.iter_trees_with_polytomies(paths['trees_path']))
+    real_tree_file_name = f"g{polytomies}_{degree}_{cluster_size}_0.pruned.tree"
+    re_tree_newick = utils.read_newick_from_file(paths['real_trees_base_path'], real_tree_file_name)
+    return tp, re_tree_newick, utils.load_hits_distance_store(paths['hits_path'], workers=1)
+
+
+def _distance_matrices(tp: TreePolytomies, distance_pairs: DistanceStore) -> list[tuple[int, np.ndarray, list[str]]]:
+    matrices = []
+    for x in tp.get_nodes_with_polytomies():
+        Y = tp.get_ys(x)
+        D, _, _ = dms.compute_distance_matrix(distance_pairs, [tp.get_cluster(x, y_i) for y_i in Y], Y)
+        matrices.append((x, D, [str(y) for y in Y]))
+    return matrices
+
+
+def bench_compute_distance_matrix(
+        directory: str, seed: int, repeats: int, degree: int, cluster_size: int, missing: float
+) -> tuple[int, list[float]]:
+    tp, _, distance_pairs = _synthetic_og(directory, seed, 1, degree, cluster_size, missing)
+    return degree * cluster_size, time_call(lambda: _distance_matrices(tp, distance_pairs), repeats)
+
+
+def bench_neighbor_joining(
+        directory: str, seed: int, repeats: int, taxa: int, missing: float, engine: str
+) -> tuple[int, list[float]]:
+    tp, _, distance_pairs = _synthetic_og(directory, seed, 1, taxa, 2, missing)
+    [(_, D, Y)] = _distance_matrices(tp, distance_pairs)
+    return taxa, time_call(lambda: nnj.resolve_polytomy_with_nan(D, Y, engine), repeats)
+
+
+def bench_update_tree_with_newick(
+        directory: str, seed: int, repeats: int, degree: int, cluster_size: int
+) -> tuple[int, list[float]]:
+    tp, _, distance_pairs = _synthetic_og(directory, seed, 1, degree, cluster_size, 0.0)
+    [(x, D, Y)] = _distance_matrices(tp, distance_pairs)
+    newick = nnj.resolve_polytomy_with_nan(D, Y).to_newick()
+    tree = tp.get_tree()
+    return len(tree), time_call(lambda: utils.update_tree_with_newick(tree, x, newick), repeats)
+
+
+def bench_get_precision_recall_contradiction(
+        directory: str, seed: int, repeats: int, polytomies: int, degree: int, cluster_size: int
+) -> tuple[int, list[float]]:
+    tp, re_tree_newick, _ = _synthetic_og(directory, seed, polytomies, degree, cluster_size, 0.0)
+    tree, real_tree = utils.custom_tree(write_nhx(tp.get_tree())), utils.custom_tree(re_tree_newick)
+    return (polytomies * degree * cluster_size,
+            time_call(lambda: utils.get_precision_recall_contradiction(tree, real_tree), repeats))
+
+
+def bench_computations(
+        directory: str, seed: int, repeats: int, ogs: int, workers: int | None
+) -> tuple[int, list[float]]:
+    paths = write_dataset(directory, ogs, seed=seed, **COMPUTATIONS_OG)
+    output_file = os.path.join(directory, 'results.tsv')
+
+    def run():
+        with redirect_stdout(io.StringIO()):
+            computations(**paths, output_file=output_file, workers=workers)
+
+    return ogs, time_call(run, repeats)
+
+
+BENCHMARKS = {
+    'compute_distance_matrix': bench_compute_distance_matrix,
+    'neighbor_joining': bench_neighbor_joining,
+    'update_tree_with_newick': bench_update_tree_with_newick,
+    'get_precision_recall_contradiction': bench_get_precision_recall_contradiction,
+    'computations': bench_computations,
+}
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+        sweeps: dict[str, dict[str, list]] = SWEEPS, seed: int = 0, repeats: int = 5, computations_repeats: int = 1
+) -> dict:
+    """
+    Run every case of the sweeps, each on freshly generated synthetic data (the same for the same seed), and return
+    {'meta': {...}, 'results': [{'benchmark', 'params', 'size', 'seconds', 'min', 'median'}, ...]}.
+
+    :param repeats: Timed calls per case of the stage benchmarks.
+    :param computations_repeats: Timed calls per case of the computations benchmark.
+    """
+    results = []
+    for name, sweep in sweeps.items():
+        for values in product(*sweep.values()):
+            params = dict(zip(sweep.keys(), values))
+            with tempfile.TemporaryDirectory() as directory:
+                size, seconds = BENCHMARKS[name](
+                    directory, seed, computations_repeats if name == 'computations' else repeats, **params
+                )
+            results.append({
+                'benchmark': name, 'params': params, 'size': size, 'seconds': seconds,
+                'min': min(seconds), 'median': float(np.median(seconds)),
+            })
+            print(f"{name} {params}: size = {size}, median = {results[-1]['median']:.6f} s")
+
+    return {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'), 'commit': _git_commit(), 'seed': seed,
+            'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+
+
+def _case_key(result: dict) -> str:
+    return json.dumps([result['benchmark'], result['params']], sort_keys=True)
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.25) -> list[tuple[str, dict, float, float]]:
+    """
+    Return the cases of current whose median time exceeds that of the same case in baseline by more than tolerance
+    (a fraction), as (benchmark, params, baseline median, current median).
+    """
+    baseline_medians = {_case_key(result): result['median'] for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = baseline_medians.get(_case_key(result))
+        if before is not None and result['median'] > before * (1 + tolerance):
+            regressions.append((result['benchmark'], result['params'], before, result['median']))
+    return regressions
+
+
+def scaling_exponents(report: dict) -> list[tuple[str, dict, int, int, float]]:
+    """
+    Empirical scaling of every benchmark: for cases that differ only in size, the exponent k of time ~ size^k
+    between consecutive sizes, as (benchmark, fixed params, size 1, size 2, k). A jump of k marks a knee.
+    """
+    series: dict[str, list[tuple[int, float]]] = {}
+    fixed: dict[str, tuple[str, dict]] = {}
+    for result in report['results']:
+        sweep = SWEEPS.get(result['benchmark'], {})
+        # The first parameter of a sweep is the one that sets the size
+        params = {key: value for key, value in result['params'].items() if key != next(iter(sweep), None)}
+        key = json.dumps([result['benchmark'], params], sort_keys=True)
+        series.setdefault(key, []).append((result['size'], result['median']))
+        fixed[key] = (result['benchmark'], params)
+
+    exponents = []
+    for key, points in series.items():
+        points.sort()
+        for (n1, t1), (n2, t2) in zip(points, points[1:]):
+            if n1 != n2 and t1 > 0 and t2 > 0:
+                exponents.append((*fixed[key], n1, n2, log(t2 / t1) / log(n2 / n1)))
+    return exponents
+
+
+def main():
+    # File paths
+    output_path:    str = "../output/benchmarks/"                   # One JSON report per run
+    baseline_file:  str = "../output/benchmarks/baseline.json"      # Report the new one is compared with, if any
+    seed:           int = 0                                         # Seed of the synthetic data
+    repeats:        int = 5                                         # Timed calls per stage case
+    tolerance:      float = 0.25                                    # Slowdown reported as a regression
+
+    #  -----------------------------------------------------------------------------------------------------------------
+
+    report = run_benchmarks(SWEEPS, seed, repeats)
+
+    os.makedirs(output_path, exist_ok=True)
+    output_file = os.path.join(output_path, f"benchmarks_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(f"Benchmark report: {output_file}")
+
+    print("Scaling exponents (time ~ size^k):")
+    for name, params, n1, n2, k in scaling_exponents(report):
+        print(f"\t{name} {params}: {n1} -> {n2}: k = {k:.2f}")
+
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            regressions = compare(json.load(f), report, tolerance)
+        print(f"Regressions against {baseline_file}: {len(regressions)}")
+        for name, params, before, after in regressions:
+            print(f"\t{name} {params}: {before:.6f} s -> {after:.6f} s")
+    else:
+        print(f"No baseline; copy {output_file} to {baseline_file} to compare the next runs with it.")
+
+
+if __name__ == "__main__":
+    main()
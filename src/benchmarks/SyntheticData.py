@@ -0,0 +1,178 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Shape of the synthetic data, mirroring the project's inputs:
+#   gene tree leaf      noD_<a>_<b>_<c>_<d>|G<k>_<s>[node_id=<k>;species=H<s>]
+#   real tree file      true_gene_trees/<a>_<b>_<c>_/g<a>_<b>_<c>_<d>.pruned.tree, leaves G<k>_<s>
+#   hits file           H<s>.vs.H<t>.diamond.alignment_hits (DIAMOND columns, no header)
+# with <a>_<b>_<c> = polytomies_degree_cluster-size and <d> = the OG number.
+_HITS_COLUMNS = ['Query_accession', 'Target_accession', 'Query_length', 'Target_length',
+                 'Alignment_length', 'Bit_score', 'Evalue']
+_MIN_BRANCH, _MAX_BRANCH = 0.02, 0.3    # Real tree branch lengths, in substitutions per site
+_MIN_LENGTH, _MAX_LENGTH = 200, 1000    # Protein lengths
+
+
+def _random_binary_tree(rng: np.random.Generator, items: list) -> list | object:
+    """
+    Join the items (leaves or subtrees) two at a time, picked at random, until one tree remains; an inner node is
+    the list of its two children.
+    """
+    items = list(items)
+    while len(items) > 1:
+        i, j = sorted(rng.choice(len(items), size=2, replace=False))
+        right, left = items.pop(j), items.pop(i)
+        items.append([left, right])
+    return items[0]
+
+
+def _real_tree(rng: np.random.Generator, tree, labels: list[str]) -> tuple[str, list[int], np.ndarray, np.ndarray]:
+    """
+    Draw the branch lengths of a binary tree of gene indices and return its Newick text (no ';'), its genes in
+    order, their depth below its root and the path length between every two of them.
+    """
+    if not isinstance(tree, list):
+        return labels[tree], [tree], np.zeros(1), np.zeros((1, 1))
+
+    texts, genes, depths, paths = [], [], [], []
+    for child in tree:
+        text, child_genes, child_depths, child_paths = _real_tree(rng, child, labels)
+        length = rng.uniform(_MIN_BRANCH, _MAX_BRANCH)
+        texts.append(f"{text}:{length:.6f}")
+        genes.append(child_genes)
+        depths.append(child_depths + length)
+        paths.append(child_paths)
+
+    cross = depths[0][:, None] + depths[1][None, :]
+    path = np.block([[paths[0], cross], [cross.T, paths[1]]])
+    return f"({','.join(texts)})", genes[0] + genes[1], np.concatenate(depths), path
+
+
+def _gene_tree(tree, polytomies: list, labels: list[str], node_ids: list[int]) -> str:
+    """
+    NHX text (no ';') of the gene tree: the real tree's top and cluster structure with every polytomy block (a
+    list of clusters in polytomies) flattened into a single node.
+    """
+    if not isinstance(tree, list):
+        return labels[tree]
+
+    children = tree
+    for block in polytomies:
+        if tree is block[0]:
+            children = block[1]
+            break
+    text = f"({','.join(_gene_tree(child, polytomies, labels, node_ids) for child in children)})"
+    node_ids[0] += 1
+    return f"{text}S[node_id={node_ids[0]}]"
+
+
+def synthetic_og(
+        rng: np.random.Generator, family: str, polytomies: int, degree: int, cluster_size: int, species: int
+) -> tuple[str, str, list[str], np.ndarray, np.ndarray]:
+    """
+    Generate one OG: a gene tree with polytomies nodes of degree children each, every child the root of a cluster of
+    cluster_size genes, and the real tree it was collapsed from.
+
+    The real tree is a random binary tree built in three levels: each cluster is a random binary tree of its genes,
+    each polytomy joins its clusters in a random binary order, and the polytomies are joined the same way. The gene
+    tree keeps the clusters and the top level but lists the clusters of every polytomy under one node. Genes get
+    random species out of H0..H<species - 1>.
+
+    :param family: The a_b_c_d of the leaf and real tree file names.
+    :return: The gene tree NHX, the real tree Newick, the gene tree leaf labels, their species and the path length
+             (real tree) between every two of them, rows and columns in the order of the labels.
+    """
+    n = polytomies * degree * cluster_size
+    gene_species = rng.integers(species, size=n)
+    real_labels = [f"G{k}_{s}" for k, s in enumerate(gene_species)]
+    gene_labels = [f"noD_{family}|{label}" for label in real_labels]
+    leaves = [f"{label}[node_id={k};species=H{s}]" for k, (label, s) in enumerate(zip(gene_labels, gene_species))]
+
+    genes = rng.permutation(n).reshape(polytomies, degree, cluster_size)
+    blocks = []
+    for block in genes:
+        clusters = [_random_binary_tree(rng, cluster.tolist()) for cluster in block]
+        blocks.append((_random_binary_tree(rng, clusters), clusters))
+    tree = _random_binary_tree(rng, [block for block, _ in blocks])
+
+    real_newick, order, _, paths = _real_tree(rng, tree, real_labels)
+    gene_nhx = _gene_tree(tree, blocks, leaves, [n - 1])
+
+    path = np.empty((n, n))
+    path[np.ix_(order, order)] = paths
+    return f"{gene_nhx};", f"{real_newick};", gene_labels, gene_species, path
+
+
+def synthetic_hits(
+        rng: np.random.Generator, labels: list[str], species: np.ndarray, path: np.ndarray, missing: float,
+        noise: float = 0.05
+) -> pd.DataFrame:
+    """
+    DIAMOND hits between the genes of one OG, in both directions, such that the project's scoredist of a pair is
+    100 * (its path length in the real tree + a normal noise of scale noise, drawn per direction).
+
+    Only genes of different species have hits (the project never aligns a species with itself); a fraction missing
+    of those pairs is dropped on top of that.
+
+    :return: The hits, with the columns of the hits files plus 'query_species' and 'target_species'.
+    """
+    lengths = rng.integers(_MIN_LENGTH, _MAX_LENGTH + 1, size=len(labels))
+    i, j = np.triu_indices(len(labels), k=1)
+    kept = (species[i] != species[j]) & (rng.random(len(i)) >= missing)
+    i, j = i[kept], j[kept]
+
+    # Both directions of every pair
+    query, target = np.concatenate((i, j)), np.concatenate((j, i))
+    bit_score = 2 * lengths[target] * np.exp(-path[query, target] + rng.normal(0, noise, size=len(query)))
+    labels = np.asarray(labels, dtype=object)
+    return pd.DataFrame({
+        'Query_accession': labels[query], 'Target_accession': labels[target],
+        'Query_length': lengths[query], 'Target_length': lengths[target],
+        'Alignment_length': np.minimum(lengths[query], lengths[target]),
+        'Bit_score': np.round(bit_score, 1), 'Evalue': 0.0,
+        'query_species': species[query], 'target_species': species[target],
+    })
+
+
+def write_dataset(
+        path: str, ogs: int, polytomies: int, degree: int, cluster_size: int, missing: float, species: int = 8,
+        seed: int = 0
+) -> dict[str, str]:
+    """
+    Write a synthetic project under path, laid out like input/, with ogs OGs of the same shape (see synthetic_og and
+    synthetic_hits). The same arguments always write the same files.
+
+    :return: The hits_path, trees_path and real_trees_base_path arguments of main.computations.
+    """
+    rng = np.random.default_rng(seed)
+    paths = {
+        'hits_path': os.path.join(path, 'alignment_all_vs_all', ''),
+        'trees_path': os.path.join(path, 'reconciliation.tsv'),
+        'real_trees_base_path': os.path.join(path, 'true_gene_trees', ''),
+    }
+    folder = f"{polytomies}_{degree}_{cluster_size}_"
+    os.makedirs(paths['hits_path'], exist_ok=True)
+    os.makedirs(os.path.join(paths['real_trees_base_path'], folder), exist_ok=True)
+
+    trees, hits = [], []
+    for og in range(ogs):
+        gene_nhx, real_newick, labels, gene_species, path_lengths = synthetic_og(
+            rng, f"{folder}{og}", polytomies, degree, cluster_size, species
+        )
+        trees.append(gene_nhx)
+        hits.append(synthetic_hits(rng, labels, gene_species, path_lengths, missing))
+        with open(os.path.join(paths['real_trees_base_path'], folder, f"g{folder}{og}.pruned.tree"), 'w') as f:
+            f.write(real_newick)
+
+    pd.DataFrame({'OG': range(ogs), 'tree': trees, 'reconciliation_map': '', 'flipped_nodes': ''}).to_csv(
+        paths['trees_path'], sep='\t', index=False
+    )
+
+    # One file per ordered pair of species; a pair of species with no hit gets no files
+    hits = pd.concat(hits, ignore_index=True)
+    for (query_species, target_species), pair_hits in hits.groupby(['query_species', 'target_species']):
+        file_name = f"H{query_species}.vs.H{target_species}.diamond.alignment_hits"
+        pair_hits[_HITS_COLUMNS].to_csv(
+            os.path.join(paths['hits_path'], file_name), sep='\t', header=False, index=False
+        )
+    return paths
@@ -40,7 +40,7 @@ def main():
     # TODO: Handle the case where the polytomy forms a simple star tree.
     # In such cases, distances should be taken as-is (raw distances), and no "distance estimates" should be computed.
     # This can likely be addressed with a conditional check (e.g., an 'if' statement).
-    D, _, info = dms.compute_distance_matrix(distance_pairs, C, Y)
+    D, _, info = dms.compute_distance_matrix(distance_pairs, C, Y, diagnostics=dms.DIAGNOSTICS_FULL)
     print(f"{info}\n{'-'*80}\n")
 
     # Resolve polytomy using NJ
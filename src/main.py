@@ -1,11 +1,27 @@
+import os
 import csv
+import argparse
+import numpy as np
 import pandas as pd
 import networkx as nx
 import Utils.Utils as utils
+import src.Utils.Triplets as triplets
+import src.Utils.Instrumentation as instrumentation
+import src.Utils.Sharding as sharding
 from src.Utils.Plots import plot
 import src.neighbor_joining.DMSeries as dms
-from revolutionhtl.nhxx_tools import get_nhx
+from src.Utils.Newick import write_nhx
 import src.neighbor_joining.NanNeighborJoining as nnj
+from typing import Iterator
+from functools import partial, lru_cache
+from itertools import islice
+from collections import deque
+from contextlib import nullcontext
+from src.Utils.DistanceStore import DistanceStore
+from src.Utils.TreeArchive import TreeArchive
+from src.Utils.ResultCache import ResultCache, result_key
+from concurrent.futures import ProcessPoolExecutor
+from src.polytomy_identification.TreePolytomies import TreePolytomies
 
 
 def extract_leaves_with_prefix(tree: nx.DiGraph) -> tuple[str, list[str]]:
@@ -32,22 +48,303 @@ def extract_leaves_with_prefix(tree: nx.DiGraph) -> tuple[str, list[str]]:
     return None, []
 
 
-def computations(hits_path: str, trees_path: str, real_trees_base_path: str, output_file: str) -> None:
-    distance_pairs, trees_with_polytomies = utils.load_distance_pairs_and_trees_with_polytomies(hits_path, trees_path)
+def custom_tree_resolutions(tree: nx.DiGraph, resolutions: dict[int, nnj.NJTree]) -> dict[int, nnj.NJTree]:
+    """
+    Renumber the resolutions of the polytomies of tree (keyed and labelled by its node IDs) to the node numbers of
+    utils.custom_compact_tree(tree): the preorder position of the node in tree.
+    """
+    position = {node: v for v, node in enumerate(nx.dfs_preorder_nodes(tree, getattr(tree, 'root', 0)))}
+    names = {str(node): str(v) for node, v in position.items()}
+    return {position[x]: nj_tree.renamed(names) for x, nj_tree in resolutions.items()}
+
+
+@lru_cache(maxsize=1024)
+def real_tree_reference(re_tree_newick: str) -> triplets.TripletReference:
+    """
+    Parse a real tree once per run (per process) into the triplet index it is compared through; cleared by
+    computations.
+    """
+    return triplets.TripletReference(utils.custom_compact_tree(re_tree_newick))
+
+
+# Source files of the code that computes a row of results.tsv from the trees and the distances
+RESOLVER_SOURCES = [
+    'main.py', 'Utils/Utils.py', 'Utils/CompactTree.py', 'Utils/Newick.py', 'Utils/Triplets.py',
+    'Utils/DistanceStore.py', 'neighbor_joining/DMSeries.py', 'neighbor_joining/NanNeighborJoining.py',
+    'polytomy_identification/TreePolytomies.py',
+]
+
+
+def resolver_code_version(sources: list[str] = RESOLVER_SOURCES) -> str:
+    """
+    SHA-1 of the source files (relative to this file's folder) that compute a row of results.tsv.
+    """
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    contents = []
+    for source in sources:
+        with open(os.path.join(base_path, source), 'rb') as f:
+            contents.append(f.read())
+    return result_key(*contents)
+
+
+# Identifies how a row of results.tsv is computed from the trees and the distances; part of the checkpoint keys.
+# 'code' hashes the sources that compute it, so any edit to them invalidates the checkpointed rows; the other
+# entries only describe the methods.
+RESOLVER_SETTINGS = {
+    'code': resolver_code_version(),
+    'distance': utils.DISTANCE_METHOD,
+    'distance_matrix': 'DMSeries.compute_distance_matrix',
+    'neighbor_joining': 'NanNeighborJoining.resolve_polytomies_with_nan',
+    'metrics': 'triplets.TripletReference: precision, recall, contradiction',
+    'checkpoint_row': 'metric columns, without the OG',
+}
+
+OGS_PER_CHUNK = 16  # Enough OGs per task to batch their NJ runs, few enough to balance the load across workers
+
+_worker_distance_pairs: DistanceStore | None = None  # Distance store of a worker process, set by _init_worker
+_worker_checkpoint: dict[str, list] | None = None    # Checkpointed rows, set by _init_worker
+
+
+def _init_worker(distance_pairs: DistanceStore, checkpoint: dict[str, list] | None, instrument: bool = False) -> None:
+    # A store loaded from the cache pickles without its blocks, so each worker memory-maps them on its own
+    global _worker_distance_pairs, _worker_checkpoint
+    _worker_distance_pairs, _worker_checkpoint = distance_pairs, checkpoint
+    if instrument:
+        instrumentation.enable()
 
-    # TODO: Manually deleting the 58th tree since it's breaking the code. I'll check the causes tomorrow.
-    del trees_with_polytomies[58]
 
-    # Filtered structure to store trees and their leaves
-    filtered_trees_with_polytomies = []
+def _compute_rows_in_worker(
+        chunk: list[tuple[TreePolytomies, list[str]]], real_trees: str | TreeArchive, settings: dict
+) -> tuple[list[tuple[str, list]], dict]:
+    # The worker's instrumentation records of the chunk go back with its rows
+    rows = compute_rows(chunk, _worker_distance_pairs, real_trees, _worker_checkpoint, settings)
+    return rows, instrumentation.drain()
 
-    # Filter trees by leaf prefix
-    for tp in trees_with_polytomies:
+
+def og_key(tree: nx.DiGraph, in_tree_newick: str, re_tree_newick: str, distance_pairs: DistanceStore,
+           settings: dict) -> str:
+    """
+    Return the checkpoint key of an OG: a hash of its input tree, its real tree, the distances between its leaves
+    (the only hits it uses) and the resolver settings.
+    """
+    labels = sorted(tree.nodes[node].get('label', '') for node in tree if tree.out_degree(node) == 0)
+    return result_key(in_tree_newick, re_tree_newick or '', distance_pairs.submatrix(labels), settings)
+
+
+def compute_rows(
+        chunk: list[tuple[TreePolytomies, list[str]]], distance_pairs: DistanceStore, real_trees: str | TreeArchive,
+        checkpoint: dict[str, list] | None = None, settings: dict = RESOLVER_SETTINGS
+) -> list[tuple[str, list]]:
+    """
+    Resolve the polytomies of a chunk of filtered trees and return their rows of results.tsv with their checkpoint
+    keys (see og_key), in the chunk order. OGs whose key is in checkpoint reuse the metrics stored there.
+
+    :param chunk: (tp, leaves) of the trees that passed the leaf-prefix filter.
+    :param distance_pairs: Distances between the leaves.
+    :param real_trees: Root folder of the real gene trees, or their TreeArchive.
+    :param checkpoint: Rows of earlier runs without their OG column, by key, or None not to checkpoint: the keys
+                       are then None too.
+    :param settings: Resolver settings, part of the keys.
+    """
+    # Compute the distance matrices of the polytomies of every tree whose leaves match its real tree
+    jobs = []                                                    # (tp, key, reference, resolved_at)
+    polytomies: list[tuple[np.ndarray, list[str]]] = []          # Arguments of nnj.resolve_polytomy_with_nan
+    polytomy_ogs: list[int] = []                                 # OG of every polytomy, for the instrumentation
+    for tp, leaves in chunk:
         original_tree: nx.DiGraph = tp.get_tree()
-        prefix, leaves = extract_leaves_with_prefix(original_tree)
+        instrumentation.set_og(tp.get_og())
+        instrumentation.count('leaves', len(leaves))
+
+        # Find the corresponding real tree
+        with instrumentation.stage('write_nhx'):
+            in_tree_newick: str = write_nhx(original_tree)
+        real_tree_file_name: str = f"g{utils.extract_file_name_from_newick(in_tree_newick)}.pruned.tree"
+        with instrumentation.stage('read_real_tree'):
+            re_tree_newick: str = utils.read_newick_from_file(real_trees, real_tree_file_name)
+        # The real tree is only needed through its triplets, indexed once for both comparisons
+        with instrumentation.stage('parse_real_tree'):
+            reference = real_tree_reference(re_tree_newick)
+        real_tree = reference.get_tree()
+
+        # Compare leaves
+        real_leaf_names = [real_tree.get_label(leaf) for leaf in real_tree.get_leaves()]
+
+        if sorted(leaves) == sorted(real_leaf_names):  # Leaves match
+            key = None
+            if checkpoint is not None:  # The key hashes every distance between the leaves: only when it is used
+                with instrumentation.stage('checkpoint_key'):
+                    key = og_key(original_tree, in_tree_newick, re_tree_newick, distance_pairs, settings)
+            if key is not None and key in checkpoint:  # Unchanged since an earlier run
+                instrumentation.count('checkpointed')
+                jobs.append((tp, key, None, None))
+                distance_pairs.release()
+                continue
+
+            X: list[int] = tp.get_nodes_with_polytomies()
+            resolved_at: list[tuple[int, int]] = []  # (x, index of its polytomy in polytomies)
+
+            for x in X:
+                Y: list[int] = tp.get_ys(x)
+                C: list[list[str]] = [tp.get_cluster(x, y_i) for y_i in Y]
+                instrumentation.count('polytomies')
+                instrumentation.count('polytomy_degree', len(Y))
+                instrumentation.peak('max_polytomy_degree', len(Y))
+
+                # Compute the distance matrix for the NJ algorithm
+                with instrumentation.stage('distance_matrix'):
+                    D, _, _ = dms.compute_distance_matrix(distance_pairs, C, Y)
+
+                if not utils.is_diagonal_zero_and_nan_elsewhere(D):
+                    resolved_at.append((x, len(polytomies)))
+                    polytomies.append((D, [str(y) if isinstance(y, int) else y for y in Y]))
+                    polytomy_ogs.append(tp.get_og())
+                else:
+                    instrumentation.count('unresolvable_polytomies')
+
+            jobs.append((tp, key, reference, resolved_at))
+        else:
+            instrumentation.count('leaf_mismatch')
+
+        # Only this OG's distance block was needed; drop it so memory stays bounded by the largest OG
+        distance_pairs.release()
+
+    # Resolve all polytomies at once: those with the same number of connected taxa share one batched NJ run
+    instrumentation.set_og(None)
+    with instrumentation.owners(polytomy_ogs):
+        resolved_subtrees: list[nnj.NJTree] = nnj.resolve_polytomies_with_nan(polytomies)
 
-        if prefix:  # Tree passes the filter
-            filtered_trees_with_polytomies.append((tp, leaves))
+    rows = []
+    for tp, key, reference, resolved_at in jobs:
+        if reference is None:
+            # The key does not cover the OG number, which shifts when OGs are added or removed before this one
+            rows.append((key, [tp.get_og()] + checkpoint[key]))
+            continue
+        og = tp.get_og()
+        instrumentation.set_og(og)
+
+        # The input tree goes to its metric-ready form directly, not through its NHX text
+        with instrumentation.stage('convert_tree'):
+            in_custom_t = utils.custom_compact_tree(tp.get_tree())
+            resolutions = custom_tree_resolutions(tp.get_tree(), {x: resolved_subtrees[p] for x, p in resolved_at})
+        if instrumentation.enabled():
+            instrumentation.count('input_triplets', triplets.count_triplets(in_custom_t))
+            instrumentation.count('real_triplets', triplets.count_triplets(reference.get_tree()))
+
+        # Compute metrics: the resolved tree (nj_custom_t) is scored from the counts of in_custom_t, recounting
+        # only the triplets rooted at the resolved polytomies and at the nodes inserted below them
+        with instrumentation.stage('score_input'):
+            precision1, recall1, contradiction1 = reference.precision_recall_contradiction(in_custom_t)
+        with instrumentation.stage('score_resolved'):
+            precision2, recall2, contradiction2 = reference.resolved_precision_recall_contradiction(
+                in_custom_t, resolutions
+            )
+
+        rows.append((key, [
+            og, precision1, recall1, contradiction1, precision2, recall2, contradiction2,
+            precision1 == precision2, recall1 == recall2, contradiction1 == contradiction2
+        ]))
+
+    instrumentation.set_og(None)
+    return rows
+
+
+def _ordered_map(executor: ProcessPoolExecutor, fn, iterable, window: int) -> Iterator:
+    """
+    executor.map(fn, iterable) that keeps at most window tasks submitted ahead of the one being yielded, so a lazy
+    iterable is consumed as the results are, not all at once.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def computations(
+        hits_path: str, trees_path: str, real_trees_base_path: str, output_file: str,
+        distance_cache_path: str | None = None, workers: int | None = None, checkpoint_path: str | None = None,
+        settings: dict = RESOLVER_SETTINGS, ogs: set[int] | None = None, real_trees_archive_path: str | None = None,
+        instrument: bool = False, shard: tuple[int, int] | None = None, shard_plan: str = sharding.SHARD_PLAN_HASH,
+        check_real_trees: bool = False
+) -> None:
+    """
+    Resolve the polytomies of every gene tree and write the metrics of each OG, before and after, to output_file.
+
+    Trees are streamed from trees_path (see Utils.iter_trees_with_polytomies: only the trees with polytomies whose
+    leaves share one prefix are parsed) and processed in chunks of OGS_PER_CHUNK consecutive OGs by a pool of worker
+    processes (the distance store is handed to each worker once, at start-up). Rows are written in OG order as the
+    chunks complete, so the output does not depend on the number of workers, and only a bounded window of chunks
+    is in flight at any time.
+
+    If checkpoint_path is given, every row is also appended there, without its OG, as soon as its chunk completes,
+    keyed by og_key. A later run reuses the rows whose key did not change (same input tree, real tree, distances
+    between its leaves, settings and code), under the OG number they have now, and only recomputes the others, so an
+    interrupted run resumes where it stopped.
+
+    :param workers: Number of worker processes, also used to load the hits; None uses every CPU and 1 runs
+                    everything in the calling process.
+    :param checkpoint_path: File of the checkpointed rows (see ResultCache), or None to compute every OG without
+                            computing their keys.
+    :param settings: Resolver settings, part of the checkpoint keys (see RESOLVER_SETTINGS).
+    :param ogs: OGs to process, or None for all of them.
+    :param real_trees_archive_path: Directory of a TreeArchive of the real gene trees, packed from
+                                    real_trees_base_path on first use, or None to read the tree files one by one.
+                                    Later runs open it without looking at the tree files (see check_real_trees).
+    :param instrument: Record per-OG stage times and counters (see Instrumentation) in every process and write them
+                       next to output_file, to results_instrumentation.tsv (one row per OG) and .json (run totals).
+    :param shard: (i, N) to process only shard i of N of the OGs (see Sharding.plan_shards), writing to the shard
+                  files of output_file and checkpoint_path (results.tsv -> results.shard_i_of_N.tsv; merge_shards
+                  reassembles them). Shards share the distance cache and the real tree archive but never write
+                  them: build them first with prepare_caches, or the shard fails with FileNotFoundError.
+    :param shard_plan: One of Sharding.SHARD_PLANS.
+    :param check_real_trees: Repack the archive if the tree files changed since it was packed (see
+                             TreeArchive.exists), which stats every one of them; prepare_caches always does.
+    """
+    if shard is not None:
+        # Shards started together would race to build the shared caches, so they only read ready ones
+        stale = []
+        if distance_cache_path is not None and not utils.distance_cache_is_current(hits_path, distance_cache_path):
+            stale.append(distance_cache_path)
+        if real_trees_archive_path is not None and not TreeArchive.exists(
+                real_trees_archive_path, real_trees_base_path if check_real_trees else None
+        ):
+            stale.append(real_trees_archive_path)
+        if stale:
+            raise FileNotFoundError(f"Missing or out-of-date caches shared by the shards: {stale}. "
+                                    f"Build them first with prepare_caches (main.py --prepare).")
+        index, shards = shard
+        ogs = sharding.plan_shards(trees_path, shards, shard_plan, ogs)[index]
+        output_file = sharding.shard_file(output_file, index, shards)
+        if checkpoint_path:
+            checkpoint_path = sharding.shard_file(checkpoint_path, index, shards)
+
+    if instrument:
+        instrumentation.enable()
+
+    workers = workers or os.cpu_count() or 1
+    with instrumentation.stage('load_hits'):
+        distance_pairs = utils.load_hits_distance_store(hits_path, distance_cache_path, workers)
+    trees_with_polytomies = utils.iter_trees_with_polytomies(trees_path, ogs, same_leaf_prefix=True)
+
+    real_trees: str | TreeArchive = real_trees_base_path
+    if real_trees_archive_path is not None:
+        with instrumentation.stage('open_real_trees'):
+            if not TreeArchive.exists(real_trees_archive_path, real_trees_base_path if check_real_trees else None):
+                TreeArchive.pack(real_trees_base_path, real_trees_archive_path)
+            real_trees = TreeArchive.load(real_trees_archive_path, memory_map=True)
+    real_tree_reference.cache_clear()  # Real trees may have changed since the last run in this process
+
+    # Filter trees by leaf prefix (already done on the Newick strings; this also gives the leaves)
+    def filtered_trees_with_polytomies() -> Iterator[tuple[TreePolytomies, list[str]]]:
+        for tp in trees_with_polytomies:
+            prefix, leaves = extract_leaves_with_prefix(tp.get_tree())
+            if prefix:  # Tree passes the filter
+                yield tp, leaves
+
+    filtered = filtered_trees_with_polytomies()
+    chunks = iter(lambda: list(islice(filtered, OGS_PER_CHUNK)), [])
 
     # Open the TSV file for writing
     with open(output_file, 'w', newline='') as tsvfile:
@@ -58,71 +355,135 @@ def computations(hits_path: str, trees_path: str, real_trees_base_path: str, out
         ])
 
         # Process filtered trees
-        for tp, leaves in filtered_trees_with_polytomies:
-            original_tree: nx.DiGraph = tp.get_tree()
-            full_nx_resolved_tree: nx.DiGraph = original_tree.copy()
-
-            # Find the corresponding real tree
-            in_tree_newick: str = get_nhx(original_tree, name_attr='label')
-            real_tree_file_name: str = f"g{utils.extract_file_name_from_newick(in_tree_newick)}.pruned.tree"
-            re_tree_newick: str = utils.read_newick_from_file(real_trees_base_path, real_tree_file_name)
-            real_tree = utils.custom_tree(re_tree_newick)
-
-            # Compare leaves
-            real_leaves = [node for node in real_tree if real_tree.out_degree(node) == 0]
-            real_leaf_names = [real_tree.nodes[leaf].get('label', '') for leaf in real_leaves]
-
-            if sorted(leaves) == sorted(real_leaf_names):  # Leaves match
-                X: list[int] = tp.get_nodes_with_polytomies()
-
-                for x in X:
-                    Y: list[int] = tp.get_ys(x)
-                    C: list[list[str]] = [tp.get_cluster(x, y_i) for y_i in Y]
-
-                    # Compute the distance matrix for the NJ algorithm
-                    D, _, info = dms.compute_distance_matrix(distance_pairs, C, Y)
-
-                    if not utils.is_diagonal_zero_and_nan_elsewhere(D):
-                        resolved_subtree_newick = nnj.resolve_tree_with_nan(
-                            D, [str(y) if isinstance(y, int) else y for y in Y], x
-                        )
-                        full_nx_resolved_tree = utils.update_tree_with_newick(
-                            full_nx_resolved_tree, node=x, newick_str=resolved_subtree_newick
-                        )
-
-                # Compute Newick and custom trees
-                nj_tree_newick: str = utils.transform_newick(get_nhx(full_nx_resolved_tree, 1))
-                in_custom_t = utils.custom_tree(in_tree_newick)
-                nj_custom_t = utils.custom_tree(nj_tree_newick)
-                re_custom_t = utils.custom_tree(re_tree_newick)
-
-                # Compute metrics
-                og = tp.get_og()
-                precision1, recall1, contradiction1 = utils.get_precision_recall_contradiction(in_custom_t, re_custom_t)
-                precision2, recall2, contradiction2 = utils.get_precision_recall_contradiction(nj_custom_t, re_custom_t)
-
-                # Write results to the TSV file
-                writer.writerow([
-                    og, precision1, recall1, contradiction1, precision2, recall2, contradiction2,
-                    precision1 == precision2, recall1 == recall2, contradiction1 == contradiction2
-                ])
+        parallel = workers != 1
+        checkpoint = ResultCache(checkpoint_path) if checkpoint_path else None
+        done = checkpoint.get_rows() if checkpoint is not None else None
+        if parallel:
+            distance_pairs.release()
+        with (
+            checkpoint if checkpoint is not None else nullcontext(),
+            ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(distance_pairs, done, instrumentation.enabled())
+            ) if parallel else nullcontext() as executor,
+            instrumentation.stage('process_ogs', og=instrumentation.RUN)
+        ):
+            if parallel:
+                results = _ordered_map(
+                    executor,
+                    partial(_compute_rows_in_worker, real_trees=real_trees, settings=settings),
+                    chunks, 2 * workers
+                )
+            else:
+                results = ((compute_rows(chunk, distance_pairs, real_trees, done, settings), {})
+                           for chunk in chunks)
+
+            for rows, records in results:
+                instrumentation.merge(records)
+                for key, row in rows:
+                    if checkpoint is not None and key not in checkpoint:
+                        checkpoint.put(key, row[1:])  # Checkpointed as soon as its chunk is done, without the OG
+                    writer.writerow(row)
 
         print(f"For the output file: {output_file}, consider:")
         print("\t- precision1, recall1, contradiction1: Results of comparing (in_custom_t, re_custom_t)")
         print("\t- precision2, recall2, contradiction2: Results of comparing (nj_custom_t, re_custom_t)")
 
+    if instrument:
+        instrumentation.write(output_file)
+        instrumentation.disable()
+        print(f"Stage times and counters per OG: {instrumentation.sidecar_paths(output_file)[0]}")
+
+
+def prepare_caches(
+        hits_path: str, real_trees_base_path: str, distance_cache_path: str | None = None,
+        real_trees_archive_path: str | None = None, workers: int | None = None
+) -> None:
+    """
+    Build the distance cache and the real tree archive computations would build on first use, or bring them up to
+    date (the archive is checked against every tree file, see TreeArchive.exists). Run it once before starting the
+    shards of a sharded run, which only read them, and after editing the real trees.
+    """
+    workers = workers or os.cpu_count() or 1
+    if distance_cache_path is not None:
+        utils.load_hits_distance_store(hits_path, distance_cache_path, workers)
+    if real_trees_archive_path is not None and not TreeArchive.exists(real_trees_archive_path, real_trees_base_path):
+        TreeArchive.pack(real_trees_base_path, real_trees_archive_path)
+
+
+def merge_shards(output_file: str, shards: int, checkpoint_path: str | None = None) -> None:
+    """
+    Reassemble output_file, in OG order, from the results of the shards 0..shards-1 of a sharded run (see the shard
+    argument of computations), and its instrumentation files if every shard wrote them. The result is the file an
+    unsharded run writes.
+
+    :param checkpoint_path: Checkpoint of the sharded run, or None: the rows of the shard checkpoints that exist are
+                            added to it, so that a later unsharded run with it reuses them.
+    """
+    shard_files = [sharding.shard_file(output_file, index, shards) for index in range(shards)]
+    missing = [file for file in shard_files if not os.path.isfile(file)]
+    if missing:
+        raise FileNotFoundError(f"Missing shard results: {missing}")
+
+    sharding.merge_tsv(shard_files, output_file)
+    if all(os.path.isfile(path) for file in shard_files for path in instrumentation.sidecar_paths(file)):
+        instrumentation.merge_sidecars(shard_files, output_file)
+
+    if checkpoint_path:
+        shard_checkpoints = [sharding.shard_file(checkpoint_path, index, shards) for index in range(shards)]
+        with ResultCache(checkpoint_path) as checkpoint:
+            for shard_checkpoint_path in filter(os.path.isfile, shard_checkpoints):
+                with ResultCache(shard_checkpoint_path) as shard_checkpoint:
+                    for key, row in shard_checkpoint.get_rows().items():
+                        if key not in checkpoint:
+                            checkpoint.put(key, row)
+
 
 def main():
     # File paths
     hits_path:              str = '../input/tl_project_alignment_all_vs_all/'
     trees_path:             str = '../input/tl_project.reconciliation.tsv'
     real_trees_base_path:   str = "../input/true_gene_trees/"
+    real_trees_archive:     str = "../output/true_gene_trees_archive/"      # Packed real trees, built on first use
     tsv_output_file:        str = "../output/results.tsv"                   # File to save the results
     plots_path:             str = "../output/plots/"                        # Path to save the plots
+    distance_cache_path:    str = "../output/distance_cache/"               # Memory-mapped cache of the distances
+    workers:                int | None = None                               # Worker processes; None: every CPU
+    checkpoint_path:        str = "../output/results_checkpoint.tsv"        # Rows of earlier runs, by OG key
+    instrument:             bool = True                                     # Write stage times and counters per OG
 
     #  -----------------------------------------------------------------------------------------------------------------
 
-    computations(hits_path, trees_path, real_trees_base_path, tsv_output_file)
+    # On a cluster: 'main.py --prepare', then one 'main.py --shard i/N' job per shard, then 'main.py --merge N'
+    parser = argparse.ArgumentParser(description="Resolve the polytomies of the gene trees and score them.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--prepare', action='store_true',
+                      help="only build the distance cache and the real tree archive the shards read")
+    mode.add_argument('--shard', type=sharding.parse_shard, metavar='i/N',
+                      help="process only shard i of N (0 <= i < N) and write its own result files")
+    mode.add_argument('--merge', type=int, metavar='N',
+                      help="reassemble the results of shards 0..N-1 into the output file instead of computing")
+    parser.add_argument('--check-real-trees', action='store_true',
+                        help="repack the real tree archive if the tree files changed since it was packed")
+    parser.add_argument('--shard-plan', choices=sharding.SHARD_PLANS, default=sharding.SHARD_PLAN_HASH,
+                        help="how the OGs are split between the shards (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=workers, help="worker processes (default: every CPU)")
+    args = parser.parse_args()
+
+    if args.prepare:
+        prepare_caches(hits_path, real_trees_base_path, distance_cache_path, real_trees_archive, args.workers)
+        return
+    if args.merge is not None:
+        merge_shards(tsv_output_file, args.merge, checkpoint_path)
+    else:
+        computations(
+            hits_path, trees_path, real_trees_base_path, tsv_output_file, distance_cache_path, args.workers,
+            checkpoint_path, real_trees_archive_path=real_trees_archive, instrument=instrument, shard=args.shard,
+            shard_plan=args.shard_plan, check_real_trees=args.check_real_trees
+        )
+        if args.shard is not None:
+            return  # The plots need every OG: they are drawn after the merge
+
     df = pd.read_csv(tsv_output_file, sep='\t')
     plot(df, plots_path)
 
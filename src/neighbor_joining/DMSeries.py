@@ -1,6 +1,14 @@
 import numpy as np
 import pandas as pd
 import src.Utils.Utils as utils
+import src.Utils.Instrumentation as instrumentation
+from src.Utils.DistanceStore import DistanceStore
+
+# Levels of missing-pair diagnostics returned by compute_distance_matrix
+DIAGNOSTICS_NONE = "none"       # Only D
+DIAGNOSTICS_COUNTS = "counts"   # D and a k x k integer array with the number of missing pairs per cluster pair
+DIAGNOSTICS_FULL = "full"       # D, the dictionary listing every missing pair and its text representation
+DIAGNOSTICS_LEVELS = (DIAGNOSTICS_NONE, DIAGNOSTICS_COUNTS, DIAGNOSTICS_FULL)
 
 
 def _add_missing_pair(my_dict:dict[str, list[str]], key: str, value: str):
@@ -26,16 +34,116 @@ def __text__(D:np.ndarray, Y: list[int | str], missing_pairs: dict[str, list[str
     return text
 
 
+def _member_submatrix(PD: pd.Series | DistanceStore, C: list[list[str]]) -> np.ndarray:
+    """
+    Gather the member-by-member distance submatrix for the concatenation of all clusters in C. Only the blocks
+    between different clusters are used. For a pandas Series, only those blocks are filled and the rest is np.nan;
+    a DistanceStore fills every pair it has, including pairs inside a cluster.
+    """
+    members = [z for c in C for z in c]
+
+    if isinstance(PD, DistanceStore):
+        return PD.submatrix(members)
+
+    M = np.full((len(members), len(members)), np.nan)
+    bounds = np.cumsum([0] + [len(c) for c in C])
+    for i in range(len(C)):
+        for j in range(i + 1, len(C)):
+            for a, z_i in enumerate(C[i], bounds[i]):
+                for b, z_j in enumerate(C[j], bounds[j]):
+                    M[a, b] = M[b, a] = utils.get_pair_distance(PD, z_i, z_j)
+    return M
+
+
+def _sequential_block_sums(Mz: np.ndarray, bounds: np.ndarray, I: np.ndarray, J: np.ndarray) -> np.ndarray:
+    """
+    Sum every block Mz[C_i x C_j] for the cluster pairs (I[p], J[p]), adding the elements one by one in row-major
+    order exactly like the pair loop does, so the result is bit-identical to it.
+
+    Every member pair is labelled with the index of its cluster pair (-1 outside the blocks) and np.bincount adds
+    the weights of each label in array order, i.e. sequentially from 0.0 and row by row within a block. Only the
+    real member pairs are visited: memory stays that of Mz, whatever the cluster sizes.
+    """
+    k = len(bounds) - 1
+    cluster = np.repeat(np.arange(k), np.diff(bounds))          # Cluster of every member
+    pair = np.full((k, k), -1, dtype=np.int64)
+    pair[I, J] = np.arange(len(I))
+    labels = pair[cluster[:, None], cluster[None, :]]
+    in_block = labels >= 0
+    return np.bincount(labels[in_block], weights=Mz[in_block], minlength=len(I)).astype(np.float64)
+
+
+def _compute_distance_matrix_vectorized(
+        PD: pd.Series | DistanceStore, C: list[list[str]], Y: list[str], diagnostics: str
+) -> tuple[np.ndarray, dict[str, list[str]] | np.ndarray | None]:
+    """
+    Vectorized counterpart of the cluster-pair loop in compute_distance_matrix.
+
+    All members are gathered into one submatrix M. The number of valid pairs per cluster pair comes from
+    np.add.reduceat over the cluster boundaries and the sums from _sequential_block_sums, so D[i, j] = sum / count
+    is the same float the loop produces.
+    """
+    k = len(C)
+    sizes = np.array([len(c) for c in C], dtype=np.int64)
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+
+    M = _member_submatrix(PD, C)
+    valid = ~np.isnan(M)
+
+    D = np.zeros((k, k))
+    I, J = np.triu_indices(k, 1)
+    counts = np.zeros((k, k), dtype=np.int64)
+    if len(I):
+        non_empty = np.flatnonzero(sizes > 0)
+        if non_empty.size:
+            starts = bounds[non_empty]
+            counts[np.ix_(non_empty, non_empty)] = np.add.reduceat(
+                np.add.reduceat(valid.astype(np.int64), starts, axis=0), starts, axis=1
+            )
+        sums = _sequential_block_sums(np.where(valid, M, 0.0), bounds, I, J)
+        totals = counts[I, J]
+        if instrumentation.enabled():
+            lookups = int((sizes[I] * sizes[J]).sum())
+            instrumentation.count('pair_lookups', lookups)
+            instrumentation.count('missing_pairs', lookups - int(totals.sum()))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            D[I, J] = np.where(totals > 0, sums / np.maximum(totals, 1), np.nan)  # NaN if no valid pairs exist
+        D[J, I] = D[I, J]
+
+    if diagnostics == DIAGNOSTICS_COUNTS:
+        missing_counts = np.outer(sizes, sizes) - counts
+        np.fill_diagonal(missing_counts, 0)
+        return D, missing_counts
+
+    if diagnostics == DIAGNOSTICS_FULL:
+        missing_pairs: dict[str, list[str]] = {}
+        for i, j in zip(I, J):
+            block = valid[bounds[i]:bounds[i + 1], bounds[j]:bounds[j + 1]]
+            for a, b in np.argwhere(~block):
+                missing_pairs = _add_missing_pair(missing_pairs, f"{Y[i]},{Y[j]}", f"{C[i][a]},{C[j][b]}")
+        return D, missing_pairs
+
+    return D, None
+
+
 def compute_distance_matrix(
-        PD: pd.Series, C: list[list[str]], Y: list[str]
-) -> tuple[np.ndarray, dict[str, list[str]], str]:
+        PD: pd.Series | DistanceStore, C: list[list[str]], Y: list[str], vectorized: bool = True,
+        diagnostics: str = DIAGNOSTICS_NONE
+) -> tuple[np.ndarray, dict[str, list[str]] | np.ndarray | None, str | None]:
     """
     Compute the estimated distance matrix D based on the given "estimate" conditions.
 
-    :param PD: pandas Series where the index is frozensets of IDs (tuples) and values are floats or np.nan.
+    :param PD: pandas Series where the index is frozensets of IDs (tuples) and values are floats or np.nan,
+               or a DistanceStore holding the same pairs.
     :param C: list of lists, where each sublist contains IDs corresponding to a cluster.
     :param Y: list of taxa labels corresponding to each cluster in C.
-    :return: Symmetric distance matrix D as a 2D numpy array, a dictionary with missing pairs and a str representation
+    :param vectorized: Use the NumPy engine (one submatrix gather plus segment reductions) instead of the pair loop.
+    :param diagnostics: What to report about missing pairs, one of DIAGNOSTICS_LEVELS:
+                        - DIAGNOSTICS_NONE: nothing, the second and third elements are None (default for batch runs),
+                        - DIAGNOSTICS_COUNTS: a k x k integer array with the number of missing pairs per cluster pair,
+                          the third element is None,
+                        - DIAGNOSTICS_FULL: the dictionary with every missing pair and a str representation.
+    :return: Symmetric distance matrix D as a 2D numpy array, the missing-pair diagnostics and a str representation
     """
 
     missing_pairs: dict[str, list[str]] = {}
@@ -50,8 +158,16 @@ def compute_distance_matrix(
     if len(C) != len(Y):
         raise ValueError("The length of taxa labels (Y) must match the number of clusters (C).")
 
+    if diagnostics not in DIAGNOSTICS_LEVELS:
+        raise ValueError(f"Unknown diagnostics level '{diagnostics}', expected one of {DIAGNOSTICS_LEVELS}.")
+
+    if vectorized:
+        D, missing = _compute_distance_matrix_vectorized(PD, C, Y, diagnostics)
+        return D, missing, __text__(D, Y, missing) if diagnostics == DIAGNOSTICS_FULL else None
+
     k = len(C)  # Number of clusters
     D = np.zeros((k, k))  # Initialize the distance matrix with zeros
+    missing_counts = np.zeros((k, k), dtype=np.int64)
 
     # Iterate over all pairs of clusters (i, j)
     for i in range(k):
@@ -71,10 +187,16 @@ def compute_distance_matrix(
                                 numerator += value
                             else:  # PD[pair] = NaN
                                 total -= 1
-                                missing_pairs = _add_missing_pair(missing_pairs, f"{Y[i]},{Y[j]}", f"{z_i},{z_j}")
+                                if diagnostics == DIAGNOSTICS_FULL:
+                                    missing_pairs = _add_missing_pair(missing_pairs, f"{Y[i]},{Y[j]}", f"{z_i},{z_j}")
                         else:  # Pair not in PD
                             total -= 1
-                            missing_pairs = _add_missing_pair(missing_pairs, f"{Y[i]},{Y[j]}", f"{z_i},{z_j}")
+                            if diagnostics == DIAGNOSTICS_FULL:
+                                missing_pairs = _add_missing_pair(missing_pairs, f"{Y[i]},{Y[j]}", f"{z_i},{z_j}")
+
+                missing_counts[i, j] = missing_counts[j, i] = len(C[i]) * len(C[j]) - total
+                instrumentation.count('pair_lookups', len(C[i]) * len(C[j]))
+                instrumentation.count('missing_pairs', int(missing_counts[i, j]))
 
                 # Avoid division by zero
                 if total > 0:
@@ -84,7 +206,11 @@ def compute_distance_matrix(
 
                 D[j, i] = D[i, j]  # Ensure symmetry
 
-    return D, missing_pairs, __text__(D, Y, missing_pairs)
+    if diagnostics == DIAGNOSTICS_COUNTS:
+        return D, missing_counts, None
+    if diagnostics == DIAGNOSTICS_FULL:
+        return D, missing_pairs, __text__(D, Y, missing_pairs)
+    return D, None, None
 
 
 def test_compute_distance_matrix() -> None:
@@ -187,8 +313,15 @@ def test_compute_distance_matrix() -> None:
     # Compute distance matrix
     try:
         for PD, C, Y in test_cases:
-            D, missing_pair, text = compute_distance_matrix(PD, C, Y)
+            D, missing_pair, text = compute_distance_matrix(PD, C, Y, diagnostics=DIAGNOSTICS_FULL)
             print(text)
+            D_store, missing_counts, _ = compute_distance_matrix(
+                DistanceStore.from_series(PD), C, Y, diagnostics=DIAGNOSTICS_COUNTS
+            )
+            print(f"Missing pairs per cluster pair:\n{missing_counts}")
+            print(f"DistanceStore gives the same D: {np.array_equal(D, D_store, equal_nan=True)}")
+            D_loop, _, _ = compute_distance_matrix(PD, C, Y, vectorized=False)
+            print(f"Pair loop gives the same D: {np.array_equal(D, D_loop, equal_nan=True)}\n")
             # print(missing_pair)
             # print(f"{D}\n")
     except ValueError as e:
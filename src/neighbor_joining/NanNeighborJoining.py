@@ -1,4 +1,21 @@
 import numpy as np
+import src.Utils.Instrumentation as instrumentation
+
+# Neighbor Joining engines accepted by resolve_tree_with_nan
+NJ_ENGINE_CANONICAL = "canonical"   # neighbor_joining: rebuilds D and Q on every merge
+NJ_ENGINE_IN_PLACE = "in_place"     # neighbor_joining_in_place: one preallocated buffer, incremental row sums
+NJ_ENGINE_RAPID = "rapid"           # neighbor_joining_rapid: RapidNJ bounded search over sorted rows
+NJ_ENGINE_AUTO = "auto"             # neighbor_joining_rapid from RAPID_NJ_MIN_TAXA connected taxa, else in_place
+NJ_ENGINES = (NJ_ENGINE_CANONICAL, NJ_ENGINE_IN_PLACE, NJ_ENGINE_RAPID, NJ_ENGINE_AUTO)
+
+# Number of connected taxa from which NJ_ENGINE_AUTO switches to the RapidNJ search
+RAPID_NJ_MIN_TAXA = 300
+
+# Number of Q-matrix elements evaluated at once by neighbor_joining_in_place
+_Q_BLOCK_ELEMENTS = 1 << 16
+
+# Number of sorted entries per row examined by the first step of the RapidNJ search (doubled on every step)
+_RAPID_FIRST_CHUNK = 8
 
 
 def validate_input(D: np.ndarray) -> None:
@@ -86,6 +103,406 @@ def neighbor_joining(D: np.ndarray, taxa: list[str]) -> dict[str, dict[str, floa
     return tree
 
 
+class NJTree:
+    """
+    Rooted binary tree built by Neighbor Joining, stored in arrays instead of string-keyed dictionaries.
+
+    Nodes 0..m-1 are the connected taxa (the leaves), in input order; every join adds the next node, so node m + t
+    is the t-th join and the last node is the root. The taxa without any known distance (disconnected nodes) are not
+    part of the binary tree; they hang from the root of the resolved polytomy with length 0.
+    """
+
+    def __init__(self, taxa: list[str], children: np.ndarray, lengths: np.ndarray, disconnected_nodes: list[str]):
+        self._taxa = taxa
+        self._children = children
+        self._lengths = lengths
+        self._disconnected_nodes = disconnected_nodes
+        # taxa = [name_0, ..., name_{m-1}]      names of the leaves 0..m-1
+        # children[t] = [c_1, c_2]              children of the internal node m + t, in join order
+        # lengths[v] = d                        length of the branch above node v (NaN for the root)
+        # disconnected_nodes = [name, ...]      taxa attached to the root of the polytomy with length 0
+
+    @classmethod
+    def from_dict(cls, tree: dict[str, dict[str, float] | float], taxa: list[str],
+                  disconnected_nodes: list[str] | None = None) -> "NJTree":
+        """
+        Build an NJTree from the nested dictionary returned by neighbor_joining.
+
+        :param tree: Tree returned by neighbor_joining (leaves first, then the joins in order).
+        :param taxa: The taxa given to neighbor_joining, before it modified the list.
+        :param disconnected_nodes: Taxa without any known distance.
+        """
+        index: dict[str, int] = {taxon: v for v, taxon in enumerate(taxa)}
+        internal = [(name, subtree) for name, subtree in tree.items() if subtree]
+        children = np.empty((len(internal), 2), dtype=np.int64)
+        lengths = np.full(len(taxa) + len(internal), np.nan)
+        for t, (name, subtree) in enumerate(internal):
+            index[name] = len(taxa) + t
+            for c, (child, length) in enumerate(subtree.items()):
+                children[t, c] = index[child]
+                lengths[index[child]] = length
+        return cls(list(taxa), children, lengths, list(disconnected_nodes or []))
+
+    @classmethod
+    def star(cls, taxa: list[str]) -> "NJTree":
+        """
+        Tree of a polytomy that cannot be resolved at all: every taxon hangs from the root.
+        """
+        return cls([], np.empty((0, 2), dtype=np.int64), np.empty(0), list(taxa))
+
+    def get_taxa(self) -> list[str]:
+        return self._taxa
+
+    def get_children(self) -> np.ndarray:
+        return self._children
+
+    def get_lengths(self) -> np.ndarray:
+        return self._lengths
+
+    def get_disconnected_nodes(self) -> list[str]:
+        return self._disconnected_nodes
+
+    def get_root(self) -> int:
+        """
+        Return the root of the binary tree, or -1 if there is none (no connected taxa).
+        """
+        return len(self._lengths) - 1
+
+    def get_parents(self) -> np.ndarray:
+        """
+        Return parent[v] for every node, -1 for the root.
+        """
+        parents = np.full(len(self._lengths), -1, dtype=np.int64)
+        parents[self._children.ravel()] = np.repeat(np.arange(len(self._taxa), len(self._lengths)), 2)
+        return parents
+
+    def renamed(self, names: dict[str, str]) -> "NJTree":
+        """
+        Return the same tree with every taxon (connected or not) renamed to names[taxon].
+        """
+        return NJTree([names[taxon] for taxon in self._taxa], self._children, self._lengths,
+                      [names[taxon] for taxon in self._disconnected_nodes])
+
+    def to_dict(self) -> dict[str, dict[str, float] | float]:
+        """
+        Return the tree as the nested dictionary neighbor_joining builds, with string-concatenated node names.
+        """
+        names: list[str] = list(self._taxa)
+        tree: dict[str, dict[str, float] | float] = {taxon: {} for taxon in self._taxa}
+        for c_1, c_2 in self._children.tolist():
+            names.append(f"({names[c_1]},{names[c_2]})")
+            tree[names[-1]] = {names[c_1]: self._lengths[c_1], names[c_2]: self._lengths[c_2]}
+        return tree
+
+    def to_newick(self, root_name: str = "X") -> str:
+        """
+        Return the Newick string resolve_tree_with_nan has always returned for this polytomy.
+        """
+        if not self._taxa:
+            leaves = ",".join([f"{taxon}:0" for taxon in self._disconnected_nodes])
+            return f"({leaves}){root_name};"
+        return to_newick({"tree": self.to_dict(), "disconnected_nodes": self._disconnected_nodes}, root_name)
+
+
+def _select_pair_with_nan(rs: np.ndarray, order: np.ndarray) -> tuple[int, int] | None:
+    """
+    When some row sums are NaN, the Q matrix of neighbor_joining has NaN entries and np.argmin returns the first one
+    in row-major order. Return the (row, column) slots of that entry, or None if every row sum is a number.
+
+    :param rs: Row sums per slot.
+    :param order: Active slots in the taxa order of neighbor_joining.
+    """
+    nan_rows = np.isnan(rs[order])
+    if not nan_rows.any():
+        return None
+    if nan_rows[0]:
+        return order[0], order[1]
+    return order[0], order[np.flatnonzero(nan_rows)[0]]
+
+
+def _near_minimum_entries(
+        buf: np.ndarray, rs: np.ndarray, n: int, tolerance: float, scratch: np.ndarray, diagonal: np.ndarray
+) -> list[tuple[int, int]]:
+    """
+    Evaluate Q(i, j) = (n - 2) D(i, j) - rs(i) - rs(j) one block of rows at a time inside scratch and return the
+    (row, column) slots of every off-diagonal entry within tolerance of the minimum.
+    """
+    block_rows = len(scratch)
+    best_q = np.inf
+    entries: list[tuple[float, int, int]] = []
+
+    for start in range(0, n, block_rows):
+        stop = min(n, start + block_rows)
+        q = scratch[:stop - start, :n]
+        np.multiply(buf[start:stop, :n], n - 2, out=q)
+        q -= rs[start:stop, None]
+        q -= rs[None, :n]
+        q[diagonal[:stop - start], diagonal[start:stop]] = np.inf
+
+        block_min = q.min()
+        if not block_min <= best_q + tolerance:
+            continue
+        if block_min < best_q:
+            best_q = block_min
+            entries = [entry for entry in entries if entry[0] <= best_q + tolerance]
+        for a, b in np.argwhere(q <= best_q + tolerance):
+            entries.append((q[a, b], start + a, b))
+
+    return [(row, col) for value, row, col in entries if value <= best_q + tolerance]
+
+
+class _InPlaceNeighborJoining:
+    """
+    State of neighbor_joining_in_place: active taxa occupy the leading n slots of one preallocated buffer. The node
+    created by a merge takes the slot of one partner and the last active slot is moved into the slot of the other,
+    so no matrix is ever reallocated.
+
+    Every node gets a rank, its position in the taxa order of neighbor_joining (survivors keep their order, merged
+    nodes go last). neighbor_joining breaks ties, including rounding-level ones such as the three equal Q values when
+    n = 3, by the exact float values of its row sums and by the position of the pair. The search therefore only
+    narrows Q down to the entries within the rounding error bound of the minimum (find_candidates), and these few
+    are re-scored with row sums summed exactly the way neighbor_joining sums them.
+    """
+
+    def __init__(self, D: np.ndarray, taxa: list[str]):
+        size = len(taxa)
+        self.n: int = size
+        self.size: int = size
+        self.taxa: list[str] = list(taxa)
+        self.children: np.ndarray = np.empty((max(size - 1, 0), 2), dtype=np.int64)
+        self.lengths: np.ndarray = np.full(max(2 * size - 1, 0), np.nan)
+        self.buf: np.ndarray = np.array(D, dtype=float)          # The only n x n allocation
+        self.rank: np.ndarray = np.arange(size, dtype=np.int64)  # rank[slot] = position in the taxa order = NJTree node
+        self.slot_of: np.ndarray = np.full(2 * size + 1, -1, dtype=np.int64)
+        self.slot_of[:size] = np.arange(size)                    # slot_of[rank] = slot, -1 once merged (and at -1)
+        self.next_rank: int = size
+        self.rs: np.ndarray = np.sum(self.buf, axis=1)           # Row sums (diagonal included), updated incrementally
+        self.new_row: np.ndarray = np.empty(size)
+        self.gathered: np.ndarray = np.empty(size)
+        self.diagonal: np.ndarray = np.arange(size)
+        self.scratch: np.ndarray | None = None                   # Q blocks, allocated on the first search
+        self.max_abs: float | None = None                        # Largest |D| seen, for the rounding error bound
+        self.first_iteration: bool = True
+
+    def exact_row_sum(self, slot: int, order: np.ndarray) -> float:
+        # neighbor_joining sums its first matrix with np.sum; every later one is the F-ordered result of
+        # np.column_stack, whose row sums numpy accumulates column by column, i.e. sequentially in taxa order
+        if self.first_iteration:
+            return self.rs[slot]
+        row = self.gathered[:len(order)]
+        np.take(self.buf[slot, :len(order)], order, out=row)
+        return np.add.accumulate(row, out=row)[-1]
+
+    def find_candidates(self, tolerance: float) -> list[tuple[int, int]]:
+        """
+        Return the (row, column) slots of the off-diagonal Q entries within tolerance of the minimum.
+        """
+        if self.scratch is None:
+            self.scratch = np.empty((max(1, min(self.n, _Q_BLOCK_ELEMENTS // max(self.n, 1))), self.n))
+        return _near_minimum_entries(self.buf, self.rs, self.n, tolerance, self.scratch, self.diagonal)
+
+    def select_pair(self, order: np.ndarray) -> tuple[int, int, float, float]:
+        """
+        Return the slots (i, j) of the Q entry that np.argmin would return in neighbor_joining, with their row sums.
+        """
+        pair = _select_pair_with_nan(self.rs, order)
+        if pair is not None:
+            i, j = pair
+            return i, j, self.rs[i], self.rs[j]
+
+        n, buf = self.n, self.buf
+        if self.max_abs is None:
+            self.max_abs = float(np.max(np.abs(buf[:n, :n])))
+        tolerance = 32 * np.finfo(float).eps * self.size * n * self.max_abs
+        candidates = self.find_candidates(tolerance)
+        if not candidates:  # Every Q is infinite
+            candidates = [(order[0], order[1])]
+
+        exact = {slot: self.exact_row_sum(slot, order) for slot in {slot for pair in candidates for slot in pair}}
+        rank = self.rank
+        i, j = min(
+            candidates,
+            key=lambda e: ((n - 2) * buf[e[0], e[1]] - exact[e[0]] - exact[e[1]], rank[e[0]], rank[e[1]])
+        )
+        return i, j, exact[i], exact[j]
+
+    def merge(self, i: int, j: int, rs_i: float, rs_j: float) -> int:
+        """
+        Join slots i and j into a new node and return the slot where it ends up.
+        """
+        n, buf, rs, rank = self.n, self.buf, self.rs, self.rank
+
+        # Branch lengths from i and j to the new node u
+        delta_i_u: float = 0.5 * buf[i, j] + (rs_i - rs_j) / (2 * (n - 2))
+        delta_j_u: float = buf[i, j] - delta_i_u
+        self.children[self.next_rank - self.size] = rank[i], rank[j]
+        self.lengths[rank[i]], self.lengths[rank[j]] = delta_i_u, delta_j_u
+
+        # Distances from u to the other taxa; u takes slot i
+        row = self.new_row[:n]
+        np.add(buf[i, :n], buf[j, :n], out=row)
+        row -= buf[i, j]
+        row /= 2
+        row[i] = row[j] = 0
+        rs[:n] -= buf[i, :n]
+        rs[:n] -= buf[j, :n]
+        rs[:n] += row
+        rs[i] = np.sum(row)
+        buf[i, :n] = row
+        buf[:n, i] = row
+        if self.max_abs is not None:
+            self.max_abs = max(self.max_abs, float(np.max(np.abs(row))))
+        self.slot_of[rank[i]] = self.slot_of[rank[j]] = -1
+        rank[i] = self.next_rank
+        self.slot_of[self.next_rank] = i
+        self.next_rank += 1
+
+        # Move the last active slot into slot j
+        last = n - 1
+        if j != last:
+            buf[j, :n] = buf[last, :n]
+            buf[:n, j] = buf[:n, last]
+            rs[j], rank[j] = rs[last], rank[last]
+            self.slot_of[rank[j]] = j
+            self.move_slot(last, j)
+
+        self.n -= 1
+        self.first_iteration = False
+        return self.slot_of[self.next_rank - 1]
+
+    def move_slot(self, source: int, target: int) -> None:
+        """
+        Hook for subclasses keeping per-slot state.
+        """
+
+    def run(self) -> NJTree:
+        while self.n > 2:
+            order = np.argsort(self.rank[:self.n])
+            self.merge(*self.select_pair(order))
+
+        # Final step: Join the last two clusters at the root, in taxa order
+        buf, rank = self.buf, self.rank
+        first, second = (0, 1) if rank[0] < rank[1] else (1, 0)
+        self.children[-1] = rank[first], rank[second]
+        self.lengths[rank[first]] = self.lengths[rank[second]] = buf[first, second] / 2
+        return NJTree(self.taxa, self.children, self.lengths, [])
+
+
+class _RapidNeighborJoining(_InPlaceNeighborJoining):
+    """
+    RapidNJ search (Simonsen, Mailund & Pedersen, 2008) on top of _InPlaceNeighborJoining.
+
+    Every row keeps its distances sorted increasingly, with the rank of the node in each column. Since
+    Q(r, c) >= (n - 2) D(r, c) - rs(r) - max(rs), a row only has to be scanned until that bound exceeds the best Q
+    found so far. The row of a node holds the nodes that were active when it was sorted, so every pair of active
+    nodes is found in the row of the newer one; entries of merged nodes are skipped and all rows are sorted again
+    whenever the number of active taxa has halved.
+    """
+
+    def __init__(self, D: np.ndarray, taxa: list[str]):
+        super().__init__(D, taxa)
+        self.sorted_d: np.ndarray | None = None       # sorted_d[slot, :] = distances of the slot's row, increasing
+        self.sorted_rank: np.ndarray | None = None    # sorted_rank[slot, :] = rank of the node in each entry, or -1
+        self.sorted_at: int = 0                       # Number of active taxa when all rows were last sorted
+
+    def sort_all_rows(self) -> None:
+        n = self.n
+        if self.sorted_d is None:
+            self.sorted_d = np.empty((self.size, self.size))
+            self.sorted_rank = np.empty((self.size, self.size), dtype=np.int64)
+        self.sorted_d[:n].fill(np.inf)
+        self.sorted_rank[:n].fill(-1)
+        for slot in range(n):
+            self.sort_row(slot)
+        self.sorted_at = n
+
+    def sort_row(self, slot: int) -> None:
+        n = self.n
+        row = self.buf[slot, :n]
+        cols = np.argsort(row, kind='stable')
+        cols = cols[cols != slot]
+        self.sorted_d[slot, :n - 1] = row[cols]
+        self.sorted_rank[slot, :n - 1] = self.rank[cols]
+        self.sorted_d[slot, n - 1:] = np.inf
+        self.sorted_rank[slot, n - 1:] = -1
+
+    def find_candidates(self, tolerance: float) -> list[tuple[int, int]]:
+        n, rs = self.n, self.rs
+        if self.sorted_d is None or 2 * n <= self.sorted_at:
+            self.sort_all_rows()
+
+        max_rs = rs[:n].max()
+        best_q = np.inf
+        entries: list[tuple[float, int, int]] = []
+        rows = np.arange(n)
+        start, width = 0, _RAPID_FIRST_CHUNK
+        while rows.size and start < self.sorted_at:
+            stop = min(self.sorted_at, start + width)
+            d = self.sorted_d[rows, start:stop]
+            cols = self.slot_of[self.sorted_rank[rows, start:stop]]
+            q = (n - 2) * d - rs[rows, None] - rs[cols]
+            q[cols < 0] = np.inf
+
+            block_min = q.min()
+            if block_min < best_q:
+                best_q = block_min
+                entries = [entry for entry in entries if entry[0] <= best_q + tolerance]
+            if block_min <= best_q + tolerance:
+                for a, b in np.argwhere(q <= best_q + tolerance):
+                    entries.append((q[a, b], rows[a], cols[a, b]))
+
+            # Keep the rows whose next entry can still be within tolerance of the minimum
+            if stop >= self.sorted_at:
+                break
+            bound = (n - 2) * self.sorted_d[rows, stop] - rs[rows] - max_rs
+            rows = rows[bound <= best_q + tolerance]
+            start, width = stop, 2 * width
+
+        # Q is only symmetric up to rounding, so both orientations of every pair are scored exactly
+        pairs = {(row, col) for value, row, col in entries if value <= best_q + tolerance}
+        return list(pairs | {(col, row) for row, col in pairs})
+
+    def move_slot(self, source: int, target: int) -> None:
+        if self.sorted_d is not None:
+            self.sorted_d[target] = self.sorted_d[source]
+            self.sorted_rank[target] = self.sorted_rank[source]
+
+    def merge(self, i: int, j: int, rs_i: float, rs_j: float) -> int:
+        u = super().merge(i, j, rs_i, rs_j)
+        if self.sorted_d is not None:
+            self.sort_row(u)
+        return u
+
+
+def neighbor_joining_in_place(D: np.ndarray, taxa: list[str]) -> NJTree:
+    """
+    Neighbor Joining on a single preallocated buffer; returns exactly the same tree as neighbor_joining, as an NJTree.
+
+    Row sums are updated incrementally and Q is evaluated in row blocks of a fixed scratch buffer, which gives
+    O(n^3) time and O(n^2) memory with no per-iteration garbage.
+
+    :param D: 2D numpy array of pairwise distances (NaN behaves as in neighbor_joining).
+    :param taxa: List of taxa names corresponding to the matrix rows/columns (not modified).
+    :return: The tree, as an NJTree.
+    """
+    return _InPlaceNeighborJoining(D, taxa).run()
+
+
+def neighbor_joining_rapid(D: np.ndarray, taxa: list[str]) -> NJTree:
+    """
+    Neighbor Joining with the RapidNJ bounded search; returns exactly the same tree as neighbor_joining, as an NJTree.
+
+    Rows are kept sorted by distance and scanned only while an upper bound on the row sums says they can still hold
+    the minimum Q entry, so most iterations touch a few entries per row instead of the whole matrix. Worth it for
+    large matrices (see RAPID_NJ_MIN_TAXA); it needs two extra n x n arrays.
+
+    :param D: 2D numpy array of pairwise distances (NaN behaves as in neighbor_joining).
+    :param taxa: List of taxa names corresponding to the matrix rows/columns (not modified).
+    :return: The tree, as an NJTree.
+    """
+    return _RapidNeighborJoining(D, taxa).run()
+
+
 def to_newick(tree_data: dict, root_name: str = "X") -> str:
     """
     Convert a nested dictionary tree to Newick format.
@@ -129,23 +546,24 @@ def to_newick(tree_data: dict, root_name: str = "X") -> str:
     return f"{unrooted_newick}{root_name};"   # I believe this should be the new return
 
 
-def resolve_tree_with_nan(full_D: np.ndarray, full_taxa: list[str], root_name: str) -> str:
+def resolve_polytomy_with_nan(full_D: np.ndarray, full_taxa: list[str], engine: str = NJ_ENGINE_AUTO) -> NJTree:
     """
-    Resolve a tree using Neighbor Joining, handling NaN values.
+    Resolve a polytomy using Neighbor Joining, handling NaN values.
 
     :param full_D: 2D numpy array of pairwise distances, possibly containing NaN.
     :param full_taxa: List of taxa names corresponding to the matrix rows/columns.
-    :param root_name: Name of the root node to add.
-    :return: Newick format string.
+    :param engine: One of NJ_ENGINES; all of them produce the same tree.
+    :return: The resolved polytomy as an NJTree; use its to_newick method to get text.
     """
+    if engine not in NJ_ENGINES:
+        raise ValueError(f"Unknown Neighbor Joining engine: {engine}. Expected one of {NJ_ENGINES}.")
+
     # Validate input
     validate_input(full_D)
 
-    # Handle the case where all distances are NaN
+    # Handle the case where all distances are NaN: all taxa as leaves under the root
     if np.all(np.isnan(full_D)):
-        # Create a Newick string with all taxa as leaves under the root_name
-        leaves = ",".join([f"{taxon}:0" for taxon in full_taxa])
-        return f"({leaves}){root_name};"
+        return NJTree.star(list(full_taxa))
 
     # Identify disconnected nodes and filter the matrix
     disconnected_nodes, connected_taxa, filtered_D = identify_disconnected_nodes(full_D, full_taxa)
@@ -153,11 +571,158 @@ def resolve_tree_with_nan(full_D: np.ndarray, full_taxa: list[str], root_name: s
     filtered_D = filtered_D.astype(float)  # Convert to float if not already
 
     # Perform NJ on connected nodes
-    tree = neighbor_joining(filtered_D, connected_taxa)
-    # print(f"Tree: {tree}")
+    if engine == NJ_ENGINE_AUTO:
+        engine = NJ_ENGINE_RAPID if len(connected_taxa) >= RAPID_NJ_MIN_TAXA else NJ_ENGINE_IN_PLACE
+    if engine == NJ_ENGINE_RAPID:
+        tree = neighbor_joining_rapid(filtered_D, connected_taxa)
+    elif engine == NJ_ENGINE_IN_PLACE:
+        tree = neighbor_joining_in_place(filtered_D, connected_taxa)
+    else:
+        tree = NJTree.from_dict(neighbor_joining(filtered_D, list(connected_taxa)), connected_taxa)
+
+    return NJTree(tree.get_taxa(), tree.get_children(), tree.get_lengths(), disconnected_nodes)
+
+
+def resolve_tree_with_nan(
+        full_D: np.ndarray, full_taxa: list[str], root_name: str, engine: str = NJ_ENGINE_AUTO
+) -> str:
+    """
+    Resolve a tree using Neighbor Joining, handling NaN values.
+
+    :param full_D: 2D numpy array of pairwise distances, possibly containing NaN.
+    :param full_taxa: List of taxa names corresponding to the matrix rows/columns.
+    :param root_name: Name of the root node to add.
+    :param engine: One of NJ_ENGINES; all of them produce the same tree.
+    :return: Newick format string.
+    """
+    return resolve_polytomy_with_nan(full_D, full_taxa, engine).to_newick(root_name)
+
 
-    # Return tree and disconnected nodes
-    return to_newick({"tree": tree, "disconnected_nodes": disconnected_nodes}, root_name)
+def neighbor_joining_batch(D: np.ndarray, taxa: list[list[str]]) -> list[NJTree]:
+    """
+    Run neighbor_joining on a batch of matrices of the same size at once, every step vectorized over the batch axis.
+
+    Each matrix goes through exactly the operations of neighbor_joining (same row sums, same Q, same np.argmin
+    tie-breaks, same delete-and-append order of the taxa), so every tree is identical to the one neighbor_joining
+    returns. Meant for many small polytomies, where the per-call overhead dominates the arithmetic.
+
+    :param D: 3D numpy array (batch x n x n) of pairwise distances.
+    :param taxa: For each matrix of the batch, the list of taxa names of its rows/columns (not modified).
+    :return: One NJTree per matrix.
+    """
+    batch, n = D.shape[0], D.shape[1]
+    size = n
+    b = np.arange(batch)
+    nodes: np.ndarray = np.tile(np.arange(n), (batch, 1))   # nodes[t, k] = NJTree node at position k of matrix t
+    children: np.ndarray = np.empty((batch, max(n - 1, 0), 2), dtype=np.int64)
+    lengths: np.ndarray = np.full((batch, max(2 * n - 1, 0)), np.nan)
+
+    # neighbor_joining sums its first matrix with np.sum; every later one is the F-ordered result of np.column_stack,
+    # whose row sums numpy accumulates sequentially
+    row_sums: np.ndarray = np.sum(D, axis=2)
+
+    while n > 2:
+        # Steps 1-2: Q matrices and the first minimum of each
+        Q: np.ndarray = (n - 2) * D - row_sums[:, :, None] - row_sums[:, None, :]
+        Q[:, np.arange(n), np.arange(n)] = np.inf
+        i, j = np.divmod(np.argmin(Q.reshape(batch, -1), axis=1), n)
+
+        # Step 3: Branch lengths to the new nodes
+        D_ij: np.ndarray = D[b, i, j]
+        delta_i_u: np.ndarray = 0.5 * D_ij + (row_sums[b, i] - row_sums[b, j]) / (2 * (n - 2))
+        delta_j_u: np.ndarray = D_ij - delta_i_u
+        u = 2 * size - n
+        children[:, u - size, 0], children[:, u - size, 1] = nodes[b, i], nodes[b, j]
+        lengths[b, nodes[b, i]], lengths[b, nodes[b, j]] = delta_i_u, delta_j_u
+
+        # Step 4: Drop i and j, keeping the order of the other taxa, and append the new node last
+        keep = np.ones((batch, n), dtype=bool)
+        keep[b, i] = keep[b, j] = False
+        keep = np.nonzero(keep)[1].reshape(batch, n - 2)
+        new_distances: np.ndarray = (D[b, i, :] + D[b, j, :] - D_ij[:, None]) / 2
+
+        D_next = np.empty((batch, n - 1, n - 1))
+        D_next[:, :n - 2, :n - 2] = D[b[:, None, None], keep[:, :, None], keep[:, None, :]]
+        D_next[:, n - 2, :n - 2] = D_next[:, :n - 2, n - 2] = new_distances[b[:, None], keep]
+        D_next[:, n - 2, n - 2] = 0
+        D = D_next
+
+        # Step 5: Update the node lists
+        nodes = np.column_stack((nodes[b[:, None], keep], np.full(batch, u)))
+
+        n -= 1
+        row_sums = np.add.accumulate(D, axis=2)[:, :, -1]
+
+    # Final step: Join the last two clusters of every tree at its root
+    children[:, -1, 0], children[:, -1, 1] = nodes[:, 0], nodes[:, 1]
+    lengths[b, nodes[:, 0]] = lengths[b, nodes[:, 1]] = D[:, 0, 1] / 2
+
+    return [NJTree(list(taxa[t]), children[t], lengths[t], []) for t in range(batch)]
+
+
+def resolve_polytomies_with_nan(polytomies: list[tuple[np.ndarray, list[str]]]) -> list[NJTree]:
+    """
+    Batch version of resolve_polytomy_with_nan: validate and filter all matrices, group the connected ones by size
+    and run neighbor_joining_batch once per group of several polytomies of fewer than RAPID_NJ_MIN_TAXA taxa; the
+    others go through resolve_polytomy_with_nan with NJ_ENGINE_AUTO.
+
+    :param polytomies: List of (full_D, full_taxa) tuples, as the arguments of resolve_polytomy_with_nan.
+    :return: The NJTree of every polytomy, in the input order; identical to resolve_polytomy_with_nan.
+    """
+    trees: list[NJTree | None] = [None] * len(polytomies)
+    groups: dict[int, list[tuple[int, np.ndarray, list[str], list[str]]]] = {}
+
+    by_shape: dict[tuple[int, ...], list[int]] = {}
+    for p, (full_D, _) in enumerate(polytomies):
+        by_shape.setdefault(np.shape(full_D), []).append(p)
+
+    for shape, members in by_shape.items():
+        if len(shape) != 2 or shape[0] != shape[1]:
+            raise ValueError("Distance matrix must be square.")
+        k = shape[0]
+        full_Ds = np.stack([np.asarray(polytomies[p][0], dtype=float) for p in members]) if k else None
+
+        # Validate input and identify disconnected nodes of all matrices of this size at once
+        if k and not np.isclose(full_Ds, full_Ds.transpose(0, 2, 1), equal_nan=True).all():
+            raise ValueError("Distance matrix must be symmetric (allowing NaN).")
+        nan = np.isnan(full_Ds) if k else np.zeros((len(members), 0, 0), dtype=bool)
+        all_nan = nan.all(axis=(1, 2))
+        disconnected = (nan | np.eye(k, dtype=bool)).all(axis=2)
+
+        for m, p in enumerate(members):
+            full_taxa = polytomies[p][1]
+            if all_nan[m]:
+                trees[p] = NJTree.star(list(full_taxa))
+                continue
+
+            connected = ~disconnected[m]
+            if connected.sum() < 2:  # Let the single version fail the way it does
+                trees[p] = resolve_polytomy_with_nan(polytomies[p][0], list(full_taxa), NJ_ENGINE_CANONICAL)
+                continue
+            groups.setdefault(int(connected.sum()), []).append((
+                p, full_Ds[m][connected][:, connected],
+                [taxon for taxon, c in zip(full_taxa, connected) if c],
+                [taxon for taxon, c in zip(full_taxa, connected) if not c]
+            ))
+
+    # Neighbor Joining, one batch per number of connected taxa. A lone polytomy gains nothing from the batch and a
+    # large one runs faster through the engines of NJ_ENGINE_AUTO, whose per-step cost does not grow with the batch.
+    for size, group in groups.items():
+        if len(group) == 1 or size >= RAPID_NJ_MIN_TAXA:
+            for p, _, _, _ in group:
+                with instrumentation.shared_stage('neighbor_joining', [p]):
+                    trees[p] = resolve_polytomy_with_nan(polytomies[p][0], list(polytomies[p][1]), NJ_ENGINE_AUTO)
+            continue
+        instrumentation.count('nj_batches')
+        # The time of a batch goes in equal shares to its polytomies, all of the same size
+        with instrumentation.shared_stage('neighbor_joining', [p for p, _, _, _ in group]):
+            batch_trees = neighbor_joining_batch(
+                np.stack([D for _, D, _, _ in group]), [taxa for _, _, taxa, _ in group]
+            )
+        for (p, _, taxa, disconnected_nodes), tree in zip(group, batch_trees):
+            trees[p] = NJTree(taxa, tree.get_children(), tree.get_lengths(), disconnected_nodes)
+
+    return trees
 
 
 def test_resolve_tree_with_nan() -> None:
@@ -224,7 +789,18 @@ def test_resolve_tree_with_nan() -> None:
     root_node = "X"
 
     for input_taxa, input_D in test_cases:
-        print(f"Newick format: {resolve_tree_with_nan(input_D, input_taxa, root_node)}\n")
+        print(f"Newick format: {resolve_tree_with_nan(input_D, input_taxa, root_node)}")
+        same = all(
+            resolve_tree_with_nan(input_D, list(input_taxa), root_node, engine) ==
+            resolve_tree_with_nan(input_D, list(input_taxa), root_node, NJ_ENGINE_CANONICAL)
+            for engine in NJ_ENGINES
+        )
+        print(f"Same Newick for all engines: {same}\n")
+
+    batch = [(input_D, list(input_taxa)) for input_taxa, input_D in test_cases]
+    same = ([tree.to_newick(root_node) for tree in resolve_polytomies_with_nan(batch)] ==
+            [resolve_tree_with_nan(D, taxa, root_node) for D, taxa in batch])
+    print(f"Same Newick for the batch version: {same}")
 
 
 if __name__ == "__main__":
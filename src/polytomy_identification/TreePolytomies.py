@@ -1,5 +1,5 @@
 import networkx as nx
-from revolutionhtl.nhxx_tools import get_nhx
+from src.Utils.Newick import write_nhx
 
 
 class TreePolytomies:
@@ -47,4 +47,4 @@ class TreePolytomies:
             for y_i in self.get_ys(x):
                 text += f"\t\t{y_i = }: C_i = {self.get_cluster(x, y_i)}\n"
 
-        return f"{text}\tNewick: {get_nhx(self.get_tree(), name_attr='label')}\n"
+        return f"{text}\tNewick: {write_nhx(self.get_tree())}\n"